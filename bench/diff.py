@@ -0,0 +1,132 @@
+#!/usr/bin/python
+###
+# mw - VCS-like nonsense for MediaWiki websites
+# Copyright (C) 2011  Ian Weller <ian@ianweller.org> and others
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+###
+
+"""
+Times mw.diff against the bzrlib diff mw used before, on large pages.
+
+Pages of made up table rows are diffed unchanged, with one row changed and
+with one row in a hundred changed, the way diff_rv_to_working used to do
+it with bzrlib and the way it does now.  Outputs are checked to be equal.
+bzrlib is only needed for the comparison; without it just mw.diff is
+timed.  Results go to stdout as JSON:
+
+    python bench/diff.py --lines 1000,100000
+"""
+
+import json
+import optparse
+import os
+import platform
+import random
+import sys
+import time
+from StringIO import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'src'))
+
+import mw.diff
+
+try:
+    import bzrlib.diff
+except ImportError:
+    bzrlib = None
+
+
+def page(lines, rnd):
+    rows = ['{| class="wikitable"']
+    for i in range(lines):
+        rows.append('|-\n| %d || %s || %d' % (i, rnd.choice(['alpha', 'beta',
+                                                             'gamma']),
+                                               rnd.randint(0, 10 ** 6)))
+    rows.append('|}')
+    return '\n'.join(rows)
+
+
+def edit(text, every, rnd):
+    lines = text.split('\n')
+    for i in range(0, len(lines), every):
+        lines[rnd.randint(i, min(i + every, len(lines)) - 1)] += ' edited'
+    return '\n'.join(lines)
+
+
+def with_bzrlib(old, new):
+    old = [i + '\n' for i in old.split('\n')]
+    new = [i + '\n' for i in new.split('\n')]
+    fd = StringIO()
+    bzrlib.diff.internal_diff('a/Page', old, 'b/Page', new, fd)
+    diff = fd.getvalue()
+    if diff and diff[-1] == '\n':
+        diff = diff[:-1]
+    return diff
+
+
+def with_mw(old, new):
+    return ''.join(mw.diff.unified_diff(old, new, 'a/Page', 'b/Page'))
+
+
+def best(function, old, new, repeat):
+    seconds = None
+    for i in range(repeat):
+        start = time.time()
+        result = function(old, new)
+        elapsed = time.time() - start
+        if seconds is None or elapsed < seconds:
+            seconds = elapsed
+    return seconds, result
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]',
+                                   description=__doc__.strip().split('\n')[0])
+    parser.add_option('-l', '--lines', default='1000,10000,100000',
+                      help='comma separated page sizes in table rows '
+                      '(default %default)')
+    parser.add_option('-n', '--repeat', type='int', default=3,
+                      help='runs per diff, the fastest counts '
+                      '(default %default)')
+    options, args = parser.parse_args()
+    rnd = random.Random(0)
+    results = []
+    for lines in [int(n) for n in options.lines.split(',')]:
+        old = page(lines, rnd)
+        cases = [('unchanged', old), ('one row', edit(old, len(old), rnd)),
+                 ('1% of rows', edit(old, 100, rnd))]
+        for name, new in cases:
+            result = {'rows': lines, 'case': name, 'bytes': len(old)}
+            result['mw_s'], diff = best(with_mw, old, new, options.repeat)
+            if bzrlib is not None:
+                result['bzrlib_s'], expected = best(with_bzrlib, old, new,
+                                                    options.repeat)
+                result['same_output'] = diff == expected
+            results.append(result)
+            print >> sys.stderr, '%7d rows  %-11s mw %8.4fs  bzrlib %s' % (
+                lines, name, result['mw_s'],
+                '%8.4fs' % result['bzrlib_s'] if 'bzrlib_s' in result
+                else '-')
+    json.dump({'python': platform.python_version(),
+               'bzrlib': bzrlib is not None, 'results': results},
+              sys.stdout, indent=2, separators=(',', ': '), sort_keys=True)
+    print
+    if not all(result.get('same_output', True) for result in results):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,469 @@
+#!/usr/bin/python
+###
+# mw - VCS-like nonsense for MediaWiki websites
+# Copyright (C) 2011  Ian Weller <ian@ianweller.org> and others
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+###
+
+"""
+A stand-in for a MediaWiki api.php, good enough to run mw against.
+
+It keeps a wiki in memory and implements the parts of the API mw uses:
+query (info, revisions, categorymembers, allpages, recentchanges, tokens,
+userinfo, siteinfo, export), edit and login.  Latency and failures can be
+injected to see how mw copes with a slow or overloaded server.
+
+Run on its own, it serves a wiki of made up pages until interrupted:
+
+    python bench/mockapi.py --pages 1000 --latency 0.05
+    mw init http://127.0.0.1:8765/w/api.php
+    mw pullcat Bench
+
+bench/run.py starts one in-process instead.
+"""
+
+import BaseHTTPServer
+import hashlib
+import json
+import optparse
+import random
+import SocketServer
+import sys
+import threading
+import time
+import urlparse
+from xml.sax.saxutils import escape
+
+
+def timestamp(when=None):
+    if when is None:
+        when = time.time()
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(when))
+
+
+class MockWiki(object):
+
+    def __init__(self, latency=0.0, fail_rate=0.0, maxlag_rate=0.0,
+                 highlimits=False, max_result_size=8 * 1024 * 1024):
+        self.max_result_size = max_result_size
+        self.latency = latency
+        self.fail_rate = fail_rate
+        self.maxlag_rate = maxlag_rate
+        self.highlimits = highlimits
+        self.lock = threading.Lock()
+        self.pages = {}
+        self.titles = {}
+        self.revisions = {}
+        self.changes = []
+        self.next_pageid = 1
+        self.next_revid = 1
+        self.token = hashlib.md5(str(random.random())).hexdigest() + '+\\'
+        self.login_token = hashlib.md5(str(random.random())).hexdigest()
+        self.calls = 0
+
+    def add_page(self, title, text, user='Mock', comment='',
+                 categories=(), ns=0):
+        with self.lock:
+            return self._save(title, text, user, comment, categories, ns)
+
+    def _save(self, title, text, user, comment, categories=(), ns=0):
+        # MediaWiki drops trailing whitespace when it saves a page
+        text = text.rstrip()
+        if title in self.titles:
+            page = self.pages[self.titles[title]]
+        else:
+            page = {'pageid': self.next_pageid, 'title': title, 'ns': ns,
+                    'revisions': [], 'categories': list(categories)}
+            self.pages[self.next_pageid] = page
+            self.titles[title] = self.next_pageid
+            self.next_pageid += 1
+        rev = {'revid': self.next_revid, 'user': user, 'comment': comment,
+               'timestamp': timestamp(), '*': text,
+               'pageid': page['pageid']}
+        if page['revisions']:
+            rev['parentid'] = page['revisions'][-1]['revid']
+        self.next_revid += 1
+        page['revisions'].append(rev)
+        self.revisions[rev['revid']] = rev
+        self.changes.append({'type': page['revisions'][1:] and 'edit' or
+                             'new', 'title': title, 'ns': page['ns'],
+                             'pageid': page['pageid'],
+                             'revid': rev['revid'],
+                             'timestamp': rev['timestamp']})
+        return rev
+
+    def delete_page(self, title):
+        with self.lock:
+            page = self.pages.pop(self.titles.pop(title))
+            self.changes.append({'type': 'log', 'logtype': 'delete',
+                                 'logaction': 'delete', 'title': title,
+                                 'ns': page['ns'], 'pageid': 0,
+                                 'revid': 0, 'timestamp': timestamp()})
+
+    def call(self, params):
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if self.fail_rate and random.random() < self.fail_rate:
+            return 503, {'Retry-After': '1'}, 'Service Unavailable'
+        if 'maxlag' in params and self.maxlag_rate and \
+           random.random() < self.maxlag_rate:
+            return 200, {'Retry-After': '1', 'X-Database-Lag': '6'}, \
+                json.dumps({'error': {'code': 'maxlag', 'lag': 6,
+                                      'info': 'Waiting for db: 6 seconds '
+                                      'lagged'}})
+        action = params.get('action')
+        with self.lock:
+            if action == 'query':
+                result = self.query(params)
+            elif action == 'edit':
+                result = self.edit(params)
+            elif action == 'login':
+                result = self.login(params)
+            else:
+                result = {'error': {'code': 'unknown_action',
+                                    'info': 'Unrecognized value for '
+                                    'parameter "action"'}}
+        if isinstance(result, basestring):
+            return 200, {'Content-Type': 'text/xml; charset=utf-8'}, result
+        return 200, {'Content-Type': 'application/json; charset=utf-8'}, \
+            json.dumps(result)
+
+    def _limit(self):
+        return self.highlimits and 500 or 50
+
+    def query(self, params):
+        result = {'query': {}}
+        if 'curtimestamp' in params:
+            result['curtimestamp'] = timestamp()
+        meta = params.get('meta', '').split('|')
+        if 'tokens' in meta:
+            result['query']['tokens'] = {'csrftoken': self.token}
+        if 'userinfo' in meta:
+            rights = ['read', 'edit']
+            if self.highlimits:
+                rights.append('apihighlimits')
+            result['query']['userinfo'] = {'id': 1, 'name': 'Mock',
+                                           'rights': rights}
+        if 'siteinfo' in meta:
+            result['query']['general'] = {'sitename': 'Mock',
+                                          'time': timestamp()}
+        if params.get('list') == 'recentchanges':
+            self._recentchanges(params, result)
+        pages = self._select_pages(params, result)
+        if pages is not None:
+            if 'export' in params:
+                return self._export(pages)
+            self._describe_pages(pages, params, result)
+        if not result['query']:
+            del result['query']
+        return result
+
+    def _select_pages(self, params, result):
+        if 'titles' in params:
+            titles = params['titles'].split('|')
+            if len(titles) > self._limit():
+                result['warnings'] = {'query': {'*': 'Too many values '
+                                      'supplied for parameter "titles": '
+                                      'the limit is %d' % self._limit()}}
+                titles = titles[:self._limit()]
+            return [(self.titles.get(t), t, None) for t in titles]
+        if 'revids' in params:
+            found = []
+            for revid in params['revids'].split('|'):
+                rev = self.revisions.get(int(revid))
+                if rev is None or rev['pageid'] not in self.pages:
+                    result['query'].setdefault('badrevids', {})[revid] = \
+                        {'revid': int(revid)}
+                    continue
+                found.append((rev['pageid'], None, rev['revid']))
+            return found
+        generator = params.get('generator')
+        if generator == 'categorymembers':
+            return self._gen_categorymembers(params, result)
+        if generator == 'allpages':
+            return self._gen_allpages(params, result)
+        return None
+
+    def _continue(self, params, result, key, value):
+        result['continue'] = {key: value, 'continue': '-||'}
+        result['query-continue'] = {params['generator']: {key: value}}
+
+    def _gen_categorymembers(self, params, result):
+        category = params['gcmtitle']
+        limit = params.get('gcmlimit', '10')
+        limit = limit == 'max' and self._limit() or int(limit)
+        members = sorted([p['title'] for p in self.pages.values()
+                          if category in p['categories']])
+        start = int(params.get('gcmcontinue', 0))
+        chunk = members[start:start + limit]
+        if start + limit < len(members):
+            self._continue(params, result, 'gcmcontinue',
+                           str(start + limit))
+        return [(self.titles[t], t, None) for t in chunk]
+
+    def _gen_allpages(self, params, result):
+        ns = int(params.get('gapnamespace', 0))
+        limit = params.get('gaplimit', 10)
+        limit = limit == 'max' and self._limit() or int(limit)
+        titles = sorted([p['title'] for p in self.pages.values()
+                         if p['ns'] == ns])
+        start = params.get('gapcontinue', '')
+        chunk = [t for t in titles if t >= start][:limit + 1]
+        if len(chunk) > limit:
+            self._continue(params, result, 'gapcontinue', chunk[-1])
+            chunk = chunk[:limit]
+        return [(self.titles[t], t, None) for t in chunk]
+
+    def _describe_pages(self, pages, params, result):
+        prop = params.get('prop', '').split('|')
+        rvprop = params.get('rvprop', 'ids|timestamp|flags|comment|user')
+        rvprop = rvprop.split('|')
+        out = {}
+        missing = -1
+        result_size = 0
+        for pageid, title, revid in pages:
+            if pageid is None or pageid not in self.pages:
+                out[str(missing)] = {'ns': 0, 'title': title, 'missing': ''}
+                missing -= 1
+                continue
+            page = self.pages[pageid]
+            last = page['revisions'][-1]
+            entry = {'pageid': pageid, 'ns': page['ns'],
+                     'title': page['title']}
+            if 'info' in prop:
+                entry['lastrevid'] = last['revid']
+                entry['length'] = len(last['*'].encode('utf-8'))
+                entry['touched'] = last['timestamp']
+                if params.get('intoken') == 'edit':
+                    entry['edittoken'] = self.token
+            if 'revisions' in prop:
+                rev = revid and self.revisions[revid] or last
+                shown = {}
+                for key in ['revid', 'parentid', 'user', 'comment',
+                            'timestamp']:
+                    if key in rev and (key in rvprop or key == 'revid' and
+                                       'ids' in rvprop or
+                                       key == 'parentid' and
+                                       'ids' in rvprop):
+                        shown[key] = rev[key]
+                if 'sha1' in rvprop:
+                    shown['sha1'] = \
+                        hashlib.sha1(rev['*'].encode('utf-8')).hexdigest()
+                if 'size' in rvprop:
+                    shown['size'] = len(rev['*'].encode('utf-8'))
+                if 'content' in rvprop:
+                    result_size += len(rev['*'])
+                    if result_size > self.max_result_size:
+                        result['warnings'] = {'result': {'*': 'This result '
+                                              'was truncated because it '
+                                              'would otherwise be larger '
+                                              'than the limit of %d bytes'
+                                              % self.max_result_size}}
+                        result['continue'] = {'rvcontinue': str(pageid),
+                                              'continue': '||'}
+                        out[str(pageid)] = entry
+                        continue
+                    shown['*'] = rev['*']
+                if revid and str(pageid) in out:
+                    out[str(pageid)]['revisions'].append(shown)
+                    continue
+                entry['revisions'] = [shown]
+            out[str(pageid)] = entry
+        result['query']['pages'] = out
+
+    def _recentchanges(self, params, result):
+        start = params.get('rcstart', '')
+        limit = params.get('rclimit', 10)
+        limit = limit == 'max' and self._limit() or int(limit)
+        offset = int(params.get('rccontinue', 0))
+        changes = [c for c in self.changes if c['timestamp'] >= start]
+        chunk = changes[offset:offset + limit]
+        if offset + limit < len(changes):
+            result['continue'] = {'rccontinue': str(offset + limit),
+                                  'continue': '-||'}
+        rc = []
+        for change in chunk:
+            rc.append(dict(change))
+        result['query']['recentchanges'] = rc
+
+    def _export(self, pages):
+        out = ['<mediawiki xmlns="http://www.mediawiki.org/xml/export-0.10/"'
+               ' version="0.10" xml:lang="en">']
+        for pageid, title, revid in pages:
+            page = self.pages.get(pageid)
+            if page is None:
+                continue
+            rev = page['revisions'][-1]
+            out.append('<page><title>%s</title><ns>%d</ns><id>%d</id>'
+                       '<revision><id>%d</id><timestamp>%s</timestamp>'
+                       '<contributor><username>%s</username></contributor>'
+                       '<comment>%s</comment>'
+                       '<text xml:space="preserve">%s</text></revision>'
+                       '</page>' % (escape(page['title']).encode('utf-8'),
+                                    page['ns'], pageid, rev['revid'],
+                                    rev['timestamp'],
+                                    escape(rev['user']).encode('utf-8'),
+                                    escape(rev['comment']).encode('utf-8'),
+                                    escape(rev['*']).encode('utf-8')))
+        out.append('</mediawiki>')
+        return '\n'.join(out)
+
+    def login(self, params):
+        # the token dance of MediaWiki 1.15.3 to 1.26
+        if params.get('lgtoken') != self.login_token:
+            return {'login': {'result': 'NeedToken',
+                              'token': self.login_token}}
+        return {'login': {'result': 'Success',
+                          'lgusername': params.get('lgname')}}
+
+    def edit(self, params):
+        if params.get('token') != self.token:
+            return {'error': {'code': 'badtoken', 'info': 'Invalid token'}}
+        text = params.get('text', u'')
+        if 'md5' in params and \
+           hashlib.md5(text.encode('utf-8')).hexdigest() != params['md5']:
+            return {'error': {'code': 'badmd5',
+                              'info': 'The supplied MD5 hash was incorrect'}}
+        title = params['title']
+        old = None
+        if title in self.titles:
+            old = self.pages[self.titles[title]]['revisions'][-1]
+            if 'createonly' in params:
+                return {'error': {'code': 'articleexists',
+                                  'info': 'The article you tried to create '
+                                          'has been created already'}}
+            if old['*'] == text:
+                return {'edit': {'result': 'Success', 'title': title,
+                                 'pageid': old['pageid'], 'nochange': ''}}
+            # no merging, any other newer revision is a conflict
+            if 'baserevid' in params and \
+               int(params['baserevid']) != old['revid']:
+                return {'error': {'code': 'editconflict',
+                                  'info': 'Edit conflict'}}
+        # a pre-save transform, like the one that expands signatures
+        text = text.replace(u'~~~~', u'[[User:Mock|Mock]]')
+        rev = self._save(title, text, 'Mock',
+                         params.get('summary', u''))
+        return {'edit': {'result': 'Success', 'title': title,
+                         'pageid': rev['pageid'],
+                         'oldrevid': old and old['revid'] or 0,
+                         'newrevid': rev['revid'],
+                         'newtimestamp': rev['timestamp']}}
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    # one write per response, small writes and delayed ACKs stall
+    # keep-alive connections
+    wbufsize = -1
+
+    def do_GET(self):
+        self._answer(urlparse.urlparse(self.path).query)
+
+    def do_POST(self):
+        length = int(self.headers.getheader('Content-Length') or 0)
+        self._answer(self.rfile.read(length))
+
+    def _answer(self, query):
+        params = dict((key.decode('utf-8'), value.decode('utf-8'))
+                      for key, value in urlparse.parse_qsl(
+                          query, keep_blank_values=True))
+        code, headers, body = self.server.wiki.call(params)
+        if 'gzip' in (self.headers.getheader('Accept-Encoding') or '') and \
+           len(body) > 1024:
+            body = _gzip(body)
+            headers['Content-Encoding'] = 'gzip'
+        self.send_response(code)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Set-Cookie', 'mocksession=1; Path=/')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def _gzip(body):
+    import gzip
+    from StringIO import StringIO
+    buf = StringIO()
+    gz = gzip.GzipFile(fileobj=buf, mode='wb')
+    gz.write(body)
+    gz.close()
+    return buf.getvalue()
+
+
+class MockServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, wiki, port=0):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', port),
+                                           _Handler)
+        self.wiki = wiki
+
+    @property
+    def api_url(self):
+        return 'http://127.0.0.1:%d/w/api.php' % self.server_address[1]
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+
+def populate(wiki, count, category=u'Category:Bench'):
+    """
+    Adds count small pages to wiki, all of them members of category.
+    """
+    for i in range(count):
+        wiki.add_page(u'Page %d' % i,
+                      u'Text of page %d\n\nSome more text, with a [[link]] '
+                      u'and {{a template}}.' % i, categories=[category])
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]',
+                                   description='serve a made up wiki')
+    parser.add_option('-n', '--pages', type='int', default=10,
+                      help='number of pages, all in Category:Bench')
+    parser.add_option('-p', '--port', type='int', default=8765)
+    parser.add_option('--latency', type='float', default=0.0,
+                      help='seconds every request takes at least')
+    parser.add_option('--fail-rate', type='float', default=0.0,
+                      help='share of requests answered with a 503')
+    parser.add_option('--maxlag-rate', type='float', default=0.0,
+                      help='share of maxlag requests refused as lagged')
+    parser.add_option('--highlimits', action='store_true', default=False,
+                      help='act as if logged in as a bot')
+    options, args = parser.parse_args()
+    wiki = MockWiki(latency=options.latency, fail_rate=options.fail_rate,
+                    maxlag_rate=options.maxlag_rate,
+                    highlimits=options.highlimits)
+    populate(wiki, options.pages)
+    server = MockServer(wiki, options.port)
+    print server.api_url
+    sys.stdout.flush()
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,186 @@
+#!/usr/bin/python
+###
+# mw - VCS-like nonsense for MediaWiki websites
+# Copyright (C) 2011  Ian Weller <ian@ianweller.org> and others
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+###
+
+"""
+Times mw commands on synthetic checkouts against bench/mockapi.py.
+
+For every size, a made up wiki of that many pages is served on localhost
+and a fresh checkout goes through init, a pull of all pages, a pull that
+finds everything up to date, status, diff and commit of one in a hundred
+pages.  mw runs from this source tree, one process per command, so start
+up costs are part of the timings.  The results go to stdout as JSON, along
+with the counters of mw --timings for every command:
+
+    python bench/run.py --sizes 1000,10000 > before.json
+"""
+
+import json
+import optparse
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import mockapi
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class Checkout(object):
+    """
+    A temporary mw repo tracking a MockWiki.
+    """
+
+    def __init__(self, wiki, api_url, log):
+        self.wiki = wiki
+        self.api_url = api_url
+        self.log = log
+        self.location = tempfile.mkdtemp(prefix='mw-bench-')
+        self.env = dict(os.environ)
+        self.env['PYTHONPATH'] = os.path.join(root, 'src')
+
+    def run(self, *args):
+        """
+        Runs mw with args in the checkout.  Returns the wall time it took,
+        the number of API calls the wiki saw and the counters mw kept
+        itself, see mw.timing.
+        """
+        timings = os.path.join(self.location, '.mw', 'bench-timings')
+        command = [sys.executable, os.path.join(root, 'bin', 'mw')]
+        if args[0] != 'init':
+            command += ['--timings-json', timings]
+        command += list(args)
+        calls = self.wiki.calls
+        start = time.time()
+        returncode = subprocess.call(command, cwd=self.location,
+                                     env=self.env, stdout=self.log,
+                                     stderr=self.log)
+        elapsed = time.time() - start
+        if returncode != 0:
+            raise RuntimeError('%s failed with exit code %d' %
+                               (' '.join(args), returncode))
+        counters = None
+        if os.path.exists(timings):
+            with open(timings) as fd:
+                counters = json.load(fd)
+            os.unlink(timings)
+        return elapsed, self.wiki.calls - calls, counters
+
+    def modify(self, count):
+        """
+        Appends a line to the working files of count pages.
+        """
+        for i in range(count):
+            with open(os.path.join(self.location, 'Page_%d.wiki' % i),
+                      'a') as fd:
+                fd.write('\nChanged by the benchmark.\n')
+
+    def remove(self):
+        shutil.rmtree(self.location)
+
+
+def bench(size, options, log):
+    wiki = mockapi.MockWiki(latency=options.latency,
+                            fail_rate=options.fail_rate,
+                            highlimits=options.highlimits)
+    mockapi.populate(wiki, size)
+    server = mockapi.MockServer(wiki).start()
+    checkout = Checkout(wiki, server.api_url, log)
+    results = []
+
+    def record(name, *args):
+        elapsed, calls, counters = checkout.run(*args)
+        results.append({'pages': size, 'command': name,
+                        'seconds': round(elapsed, 3), 'api_calls': calls,
+                        'timings': counters})
+        print >> sys.stderr, '%7d pages  %-14s %8.2fs %6d calls' % \
+            (size, name, elapsed, calls)
+
+    try:
+        init = ['init']
+        if options.packed:
+            init.append('--packed')
+        record('init', *(init + [server.api_url]))
+        with open(os.path.join(checkout.location, '.mw', 'config'),
+                  'a') as fd:
+            fd.write('\n[commit]\nrate = 0\nmaxlag = 0\n')
+        jobs = '--jobs=%d' % options.jobs
+        record('pull', 'pullcat', jobs, 'Bench')
+        record('pull-current', 'pull', jobs)
+        checkout.modify(max(1, size // 100))
+        record('status', 'status')
+        record('status-again', 'status')
+        record('diff', 'diff')
+        record('commit', 'commit', '-m', 'benchmark')
+    finally:
+        server.shutdown()
+        server.server_close()
+        if options.keep:
+            print >> sys.stderr, 'checkout kept in %s' % checkout.location
+        else:
+            checkout.remove()
+    return results
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]',
+                                   description=__doc__.strip().split('\n')[0])
+    parser.add_option('-s', '--sizes', default='1000,10000,100000',
+                      help='comma separated checkout sizes in pages '
+                      '(default %default)')
+    parser.add_option('-j', '--jobs', type='int', default=2,
+                      help='--jobs passed to pulls (default %default)')
+    parser.add_option('--latency', type='float', default=0.0,
+                      help='seconds every API request takes at least')
+    parser.add_option('--fail-rate', type='float', default=0.0,
+                      help='share of API requests answered with a 503')
+    parser.add_option('--highlimits', action='store_true', default=False,
+                      help='let the wiki treat mw as a bot')
+    parser.add_option('--packed', action='store_true', default=False,
+                      help='init checkouts with --packed')
+    parser.add_option('--keep', action='store_true', default=False,
+                      help='do not remove the checkouts afterwards')
+    parser.add_option('--log', default=os.devnull,
+                      help='file to write the output of mw to')
+    options, args = parser.parse_args()
+    sizes = [int(size) for size in options.sizes.split(',')]
+    log = open(options.log, 'a')
+    report = {
+        'started': mockapi.timestamp(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'options': {'jobs': options.jobs, 'latency': options.latency,
+                    'fail_rate': options.fail_rate,
+                    'highlimits': options.highlimits,
+                    'packed': options.packed},
+        'results': [],
+    }
+    for size in sizes:
+        report['results'] += bench(size, options, log)
+    log.close()
+    json.dump(report, sys.stdout, indent=2, separators=(',', ': '),
+              sort_keys=True)
+    print
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+#!/usr/bin/python
+###
+# mw - VCS-like nonsense for MediaWiki websites
+# Copyright (C) 2011  Ian Weller <ian@ianweller.org> and others
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+###
+
+"""
+Times how long mw takes to start for commands that do next to no work.
+
+Scripts tend to run mw many times in a row, so the fixed cost of starting
+it matters.  Every command is run a number of times in an empty checkout
+and the fastest run counts.  The modules each command ends up loading are
+checked against a list of ones that are slow to import and only needed by
+some commands.  Results go to stdout as JSON; with --max-ms the exit code
+tells whether any command was slower than that:
+
+    python bench/startup.py --max-ms 100
+"""
+
+import json
+import optparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+commands = [
+    ['--help'],
+    ['status'],
+    ['diff'],
+    ['commit', '--help'],
+]
+
+# modules that only commands talking to the wiki or using packed metadata
+# should load
+heavy = ['cookielib', 'cProfile', 'httplib', 'sqlite3', 'urllib2']
+
+# runs mw like bin/mw does and lists the modules it loaded
+probe = """
+import sys
+sys.argv[0] = 'mw'
+from mw import cli
+try:
+    cli.CLI().main()
+except SystemExit:
+    pass
+sys.stderr.write('\\nloaded: %s\\n' % ' '.join(sorted(sys.modules)))
+"""
+
+
+def run(argv, cwd, env, repeat):
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        with open(os.devnull, 'w') as devnull:
+            subprocess.call(argv, cwd=cwd, env=env, stdout=devnull,
+                            stderr=devnull)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def loaded(command, cwd, env):
+    process = subprocess.Popen([sys.executable, '-c', probe] + command,
+                               cwd=cwd, env=env, stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE)
+    out, err = process.communicate()
+    modules = err.strip().split('\n')[-1].split()[1:]
+    return sorted(set([name.split('.')[0] for name in modules]) &
+                  set(heavy))
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]',
+                                   description=__doc__.strip().split('\n')[0])
+    parser.add_option('-n', '--repeat', type='int', default=20,
+                      help='runs per command, the fastest counts '
+                      '(default %default)')
+    parser.add_option('--max-ms', type='float', default=None,
+                      help='exit with 1 if a command takes longer')
+    options, args = parser.parse_args()
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.path.join(root, 'src')
+    mw = [sys.executable, os.path.join(root, 'bin', 'mw')]
+    checkout = tempfile.mkdtemp(prefix='mw-startup-')
+    try:
+        subprocess.check_call(mw + ['init', 'http://127.0.0.1:1/w/api.php'],
+                              cwd=checkout, env=env)
+        # the first run leaves compiled modules behind
+        run(mw + ['--help'], checkout, env, 1)
+        baseline = run([sys.executable, '-c', 'pass'], checkout, env,
+                       options.repeat)
+        results = []
+        failed = False
+        for command in commands:
+            seconds = run(mw + command, checkout, env, options.repeat)
+            result = {'command': ' '.join(command),
+                      'ms': round(seconds * 1000, 1),
+                      'heavy_modules': loaded(command, checkout, env)}
+            results.append(result)
+            print >> sys.stderr, '%-14s %7.1fms  %s' % (
+                result['command'], result['ms'],
+                ' '.join(result['heavy_modules']))
+            if options.max_ms is not None and result['ms'] > options.max_ms:
+                failed = True
+    finally:
+        shutil.rmtree(checkout)
+    json.dump({'python': sys.version.split()[0],
+               'python_ms': round(baseline * 1000, 1),
+               'results': results}, sys.stdout, indent=2,
+              separators=(',', ': '), sort_keys=True)
+    print
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
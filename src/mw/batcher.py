@@ -0,0 +1,242 @@
+###
+# mw - VCS-like nonsense for MediaWiki websites
+# Copyright (C) 2011  Ian Weller <ian@ianweller.org> and others
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+###
+
+import collections
+import itertools
+import threading
+import time
+
+
+class Batcher(object):
+    """
+    Hands out API requests for a list of titles, sizing each batch by how
+    the previous ones went: batches grow while responses come back quickly
+    and shrink after timeouts, maxlag errors, server errors or responses
+    that were large or truncated.  Titles of failed batches and pages the
+    wiki left out of a truncated response are queued again.
+
+    Iterating over a batcher yields request dicts; call() sends one of
+    them.  Both may be used from several threads at once.  Pages that do
+    not fit into a response even on their own end up in too_large.  Titles
+    may come from any iterable, they are only taken from it as batches
+    need them.
+
+    Answers that are not JSON, like exports, are sent with open() instead
+    of call(); whoever reads the body tells the batcher how it went with
+    finished() or failed().
+
+    Requests are sent with maxlag, so a lagged wiki turns batches away
+    until its replicas catch up.
+    """
+
+    # how long a request may take before batches stop growing
+    target_time = 2.0
+    # how much page content a response may carry before batches shrink;
+    # half of MediaWiki's default $wgAPIMaxResultSize
+    target_bytes = 4 * 1024 * 1024
+    # how often a single title may fail before giving up
+    max_failures = 5
+    # seconds of replication lag at which the wiki should refuse our
+    # requests, 0 to not send maxlag
+    maxlag = 5
+
+    def __init__(self, api, titles, make_request, limit, size=25):
+        self.api = api
+        self.titles = iter(titles)
+        self.pending = collections.deque()
+        self.make_request = make_request
+        self.limit = limit
+        self.size = max(1, min(size, limit))
+        self.failures = 0
+        self.too_large = []
+        self.lock = threading.Lock()
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        with self.lock:
+            if len(self.pending) < self.size:
+                self.pending.extend(itertools.islice(self.titles,
+                                                     self.limit))
+            if not self.pending:
+                raise StopIteration
+            titles = []
+            while self.pending and len(titles) < self.size:
+                titles.append(self.pending.popleft())
+        return self.make_request(titles)
+
+    def _requeue(self, titles):
+        with self.lock:
+            self.pending.extendleft(reversed(titles))
+
+    def _shrink(self):
+        with self.lock:
+            self.size = max(1, self.size // 2)
+
+    def _grow(self):
+        with self.lock:
+            self.size = min(self.limit, self.size + self.size // 2 + 1)
+
+    def call(self, data):
+        """
+        Sends a request made by this batcher and returns the response, or
+        None if the request failed in a way that calls for smaller batches;
+        its titles are then queued again.
+        """
+        # only loaded once there is something to send, they are slow to
+        # import
+        import httplib
+        import socket
+        import urllib2
+        titles = data['titles'].split('|')
+        data = self._with_maxlag(data)
+        start = time.time()
+        try:
+            # failures are handled here, with smaller batches
+            response = self.api.call(data, retries=0)
+        except (socket.timeout, socket.error, httplib.HTTPException,
+                urllib2.URLError), e:
+            if isinstance(e, urllib2.HTTPError) and e.code < 500:
+                raise
+            return self._failed(titles, e, 1)
+        elapsed = time.time() - start
+        if 'error' in response and response['error']['code'] == 'maxlag':
+            lag = response['error'].get('lag', 5)
+            return self._failed(titles, None, lag)
+        if 'error' in response:
+            return response
+        truncated = []
+        if 'revisions' in data.get('prop', ''):
+            truncated = self._truncated(response)
+        if len(titles) == 1 and truncated:
+            with self.lock:
+                self.too_large += truncated
+        elif truncated:
+            self._requeue(truncated)
+        size = 0
+        for page in response['query']['pages'].values():
+            for revision in page.get('revisions', []):
+                size += len(revision.get('*', ''))
+        self.finished(titles, elapsed, size, truncated)
+        return response
+
+    def open(self, data):
+        """
+        Sends a request made by this batcher like call(), but returns the
+        open response body, or None after a failure like those of call().
+        """
+        import httplib
+        import socket
+        import urllib2
+        titles = data['titles'].split('|')
+        try:
+            body = self.api.open(self._with_maxlag(data))
+        except (socket.timeout, socket.error, httplib.HTTPException,
+                urllib2.URLError), e:
+            if isinstance(e, urllib2.HTTPError) and e.code < 500:
+                raise
+            return self._failed(titles, e, 1)
+        # a maxlag error is JSON whatever was asked for, only its headers
+        # tell it apart
+        lag = body.info().getheader('X-Database-Lag')
+        if lag is not None:
+            try:
+                body.read()
+            finally:
+                body.close()
+            return self._failed(titles, None, lag.isdigit() and int(lag) or 5)
+        return body
+
+    def _with_maxlag(self, data):
+        data = dict(data)
+        if self.maxlag:
+            data['maxlag'] = self.maxlag
+        return data
+
+    def finished(self, titles, elapsed, size, truncated=False):
+        """
+        Sizes the next batches by how a request for titles went: how many
+        seconds it took, how much page content it carried and whether the
+        wiki left pages out.
+        """
+        with self.lock:
+            self.failures = 0
+        if truncated or size > self.target_bytes:
+            self._shrink()
+        elif elapsed < self.target_time and len(titles) >= self.size:
+            self._grow()
+        elif elapsed > 2 * self.target_time:
+            self._shrink()
+
+    def failed(self, titles, error):
+        """
+        Queues titles again in smaller batches after a body opened with
+        open() could not be read to its end.  error is raised if the same
+        titles keep failing.
+        """
+        self._failed(titles, error, 1)
+
+    def _failed(self, titles, error, delay):
+        with self.lock:
+            self.failures += 1
+            give_up = self.failures >= self.max_failures and self.size == 1
+        if give_up:
+            if error is None:
+                raise IOError('wiki is lagged, giving up')
+            raise error
+        self._shrink()
+        self._requeue(titles)
+        time.sleep(delay)
+        return None
+
+    def _truncated(self, response):
+        """
+        Returns the titles of pages a response carries no revisions for
+        because the wiki hit its result size limit, and removes them from
+        the response.
+        """
+        warnings = response.get('warnings', {})
+        truncated = 'result' in warnings or \
+            'rvcontinue' in response.get('continue', {}) or \
+            'rvcontinue' in response.get('query-continue', {}).get(
+                'revisions', {})
+        if not truncated or 'query' not in response:
+            return []
+        pages = response['query']['pages']
+        left_out = []
+        for pageid in pages.keys():
+            page = pages[pageid]
+            if 'revisions' not in page and 'missing' not in page and \
+               'invalid' not in page:
+                left_out.append(page['title'])
+                del pages[pageid]
+        return left_out
+
+
+def title_limit(api):
+    """
+    Returns how many titles one query may carry for the logged in user:
+    500 with the apihighlimits right, 50 without.
+    """
+    response = api.call({'action': 'query', 'meta': 'userinfo',
+                         'uiprop': 'rights'})
+    rights = response.get('query', {}).get('userinfo', {}).get('rights', [])
+    if 'apihighlimits' in rights:
+        return 500
+    return 50
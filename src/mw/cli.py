@@ -17,6 +17,7 @@
 ###
 
 import mw.clicommands
+import mw.timing
 import os
 import sys
 
@@ -25,6 +26,8 @@ class CLI(object):
 
     def __init__(self):
         self.me = os.path.basename(sys.argv[0])
+        # commands are registered by their class, only the one that is run
+        # gets built
         self.commands = {}
         self.shortcuts = {}
         for name in mw.clicommands.__dict__:
@@ -33,9 +36,8 @@ class CLI(object):
             clazz = mw.clicommands.__dict__[name]
             if isinstance(clazz, type) and \
                issubclass(clazz, mw.clicommands.CommandBase):
-                cmd = clazz()
-                self.commands[cmd.name] = cmd
-                self.shortcuts[cmd.name] = cmd.shortcuts
+                self.commands[clazz.name] = clazz
+                self.shortcuts[clazz.name] = clazz.shortcuts
         self.all_commands = {}
         self.all_commands.update(self.commands)
         for command in self.shortcuts:
@@ -55,9 +57,42 @@ class CLI(object):
                 full = name
             print("\t%-14s %-25s" % (full, cmd.description))
         print
+        print 'options before the subcommand:'
+        print
+        print '\t--timings          print where the time went to stderr'
+        print '\t--timings-json F   write the same counters to F as JSON'
+        print '\t--profile F        write cProfile stats to F'
+        print
         sys.exit(1)
 
+    def _global_options(self):
+        """
+        Takes the options that apply to every subcommand off the command
+        line, so the subcommand does not see them.
+        """
+        options = {'timings': False, 'timings_json': None, 'profile': None}
+        while len(sys.argv) > 1 and sys.argv[1].startswith('--'):
+            option = sys.argv[1].split('=', 1)
+            if option[0] == '--timings' and len(option) == 1:
+                options['timings'] = True
+                del sys.argv[1]
+            elif option[0] in ['--timings-json', '--profile']:
+                if len(option) == 2:
+                    value = option[1]
+                    del sys.argv[1]
+                elif len(sys.argv) > 2:
+                    value = sys.argv[2]
+                    del sys.argv[1:3]
+                else:
+                    print '%s: %s needs a file name' % (self.me, option[0])
+                    self.usage()
+                options[option[0][2:].replace('-', '_')] = value
+            else:
+                break
+        return options
+
     def main(self):
+        options = self._global_options()
         # determine what the subcommand is
         if len(sys.argv) > 1:
             if sys.argv[1] in self.all_commands:
@@ -70,4 +105,22 @@ class CLI(object):
         if len(sys.argv) == 1:
             self.usage()
         # woo let's go
-        self.all_commands[the_command].main()
+        command = self.all_commands[the_command]()
+        profile = None
+        if options['profile'] is not None:
+            import cProfile
+            profile = cProfile.Profile()
+            profile.enable()
+        mw.timing.reset()
+        try:
+            command.main()
+        finally:
+            if profile is not None:
+                profile.disable()
+                profile.dump_stats(options['profile'])
+            if options['timings']:
+                mw.timing.report()
+            if options['timings_json'] is not None:
+                import json
+                with open(options['timings_json'], 'w') as fd:
+                    json.dump(mw.timing.as_dict(), fd)
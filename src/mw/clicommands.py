@@ -16,32 +16,39 @@
 # with this program.  If not, see <http://www.gnu.org/licenses/>.
 ###
 
-import codecs
-import cookielib
-import getpass
+import collections
 import hashlib
+import json
+import mw.batcher
 import mw.metadir
+import mw.throttle
+import mw.timing
 from optparse import OptionParser, OptionGroup
 import os
-import simplemediawiki
-import subprocess
+import Queue
 import sys
+import threading
 import time
 
 
 class CommandBase(object):
 
-    def __init__(self, name, description, usage=None):
+    # every command sets these, the CLI lists commands by them without
+    # building any
+    name = None
+    description = None
+    usage = None
+    shortcuts = []
+
+    def __init__(self):
         self.me = os.path.basename(sys.argv[0])
-        self.description = description
-        if usage is None:
-            usage = '%prog ' + name
+        if self.usage is None:
+            usage = '%prog ' + self.name
         else:
-            usage = '%%prog %s %s' % (name, usage)
-        self.parser = OptionParser(usage=usage, description=description)
-        self.name = name
+            usage = '%%prog %s %s' % (self.name, self.usage)
+        self.parser = OptionParser(usage=usage,
+                                   description=self.description)
         self.metadir = mw.metadir.Metadir()
-        self.shortcuts = []
 
     def main(self):
         (self.options, self.args) = self.parser.parse_args()
@@ -52,6 +59,7 @@ class CommandBase(object):
         pass
 
     def _login(self):
+        import getpass
         user = raw_input('Username: ')
         passwd = getpass.getpass()
         result = self.api.call({'action': 'login',
@@ -81,31 +89,275 @@ class CommandBase(object):
 
     def _api_setup(self):
         if not self.api_setup: # do not call _api_setup twice
+            # the HTTP modules take a while to load, commands that do not
+            # talk to the wiki should not wait for them
+            import mw.transport
             cookie_filename = os.path.join(self.metadir.location, 'cookies')
             self.api_url = self.metadir.config.get('remote', 'api_url')
-            self.api = simplemediawiki.MediaWiki(self.api_url,
-                                             cookie_file=cookie_filename)
+            self.api = mw.transport.Api(self.api_url,
+                                        cookie_file=cookie_filename)
             self.api_setup = True
+            self.title_limit = None
+
+    def _add_jobs_option(self):
+        self.parser.add_option('-j', '--jobs', dest='jobs', type='int',
+                               default=1,
+                               help='number of processes to read and '
+                               'compare files with (default 1)')
+
+    def _title_limit(self):
+        # asked once, the answer only changes with a new login
+        if self.title_limit is None:
+            self.title_limit = mw.batcher.title_limit(self.api)
+        return self.title_limit
 
 
 class InitCommand(CommandBase):
 
+    name = 'init'
+    description = 'start a mw repo'
+    usage = '[options] API_URL'
+
     def __init__(self):
-        usage = 'API_URL'
-        CommandBase.__init__(self, 'init', 'start a mw repo', usage)
+        CommandBase.__init__(self)
+        self.parser.add_option('--packed', dest='packed', action='store_true',
+                               help='keep page metadata in a single '
+                               'database file', default=False)
 
     def _do_command(self):
         if len(self.args) < 1:
             self.parser.error('must have URL to remote api.php')
         elif len(self.args) > 1:
             self.parser.error('too many arguments')
-        self.metadir.create(self.args[0])
+        self.metadir.create(self.args[0], packed=self.options.packed)
 
 
-class LoginCommand(CommandBase):
+class CloneCommand(CommandBase):
+
+    name = 'clone'
+    description = 'start a mw repo and pull pages into it'
+    usage = '[options] API_URL [PAGENAME ...]'
 
     def __init__(self):
-        CommandBase.__init__(self, 'login', 'authenticate with wiki')
+        CommandBase.__init__(self)
+        self.parser.add_option('--packed', dest='packed', action='store_true',
+                               help='keep page metadata in a single '
+                               'database file', default=False)
+        self.parser.add_option('-a', '--all', dest='all', action='store_true',
+                               default=False,
+                               help='pull every page of the wiki, or of the '
+                               'namespaces given with --namespace')
+        self.parser.add_option('-n', '--namespace', dest='namespaces',
+                               type='int', action='append', metavar='NS',
+                               help='namespace to pull with --all, may be '
+                               'given more than once (default 0)')
+        self.parser.add_option('-j', '--jobs', dest='jobs', type='int',
+                               default=PullCommand.default_jobs,
+                               help='number of requests to keep in flight '
+                               '(default %d, at most %d)' %
+                               (PullCommand.default_jobs,
+                                PullCommand.max_jobs))
+
+    def _do_command(self):
+        if len(self.args) < 1:
+            self.parser.error('must have URL to remote api.php')
+        if self.options.all and len(self.args) > 1:
+            self.parser.error('--all does not take page names')
+        if self.options.namespaces and not self.options.all:
+            self.parser.error('--namespace only goes with --all')
+        self.metadir.create(self.args[0], packed=self.options.packed)
+        self._die_if_no_init()
+        self._api_setup()
+        pull_command = PullCommand()
+        pull_command.metadir = self.metadir
+        pull_command.api = self.api
+        pull_command.api_setup = True
+        pull_command.title_limit = self.title_limit
+        pull_command.options.jobs = self.options.jobs
+        if not self.options.all:
+            if len(self.args) > 1:
+                pull_command._pull(self.args[1:])
+                self.metadir.save_index()
+            return
+        import mw.dump
+        # pull --changed can take over from here
+        sync_time = pull_command._server_time()
+        self.cloned = self.skipped = 0
+        # exports are sized like the batches of a pull, but are read and
+        # written here as they arrive
+        batcher = mw.batcher.Batcher(
+            self.api, self._titles(self.options.namespaces or [0]),
+            self._export_request, self._title_limit())
+        with mw.timing.phase('clone: download'):
+            for data, body in pull_command._fetch(batcher, batcher.open):
+                self._store(batcher, data, body)
+        self.metadir.save_index()
+        print '%d pages cloned' % self.cloned
+        if self.skipped:
+            print '%d pages skipped' % self.skipped
+        self.metadir.set_last_sync(sync_time)
+
+    def _titles(self, namespaces):
+        """
+        Yields the titles of the pages of the given namespaces, one listing
+        at a time.
+        """
+        for namespace in namespaces:
+            data = {
+                    'action': 'query',
+                    'generator': 'allpages',
+                    'gapnamespace': namespace,
+                    'gaplimit': 'max',
+                    'continue': '',
+            }
+            while True:
+                response = self.api.call(dict(data))
+                pages = response.get('query', {}).get('pages', {})
+                for title in sorted([page['title']
+                                     for page in pages.values()]):
+                    yield title
+                if 'continue' not in response:
+                    break
+                data.update(response['continue'])
+
+    def _export_request(self, titles):
+        return {
+                'action': 'query',
+                'titles': '|'.join(titles),
+                'export': 1,
+                'exportnowrap': 1,
+        }
+
+    def _store(self, batcher, data, body):
+        """
+        Parses an export as it is read and writes out every page as soon
+        as it is complete.  If the export breaks off, the pages that did
+        not make it are handed back to the batcher.
+        """
+        import httplib
+        import socket
+        titles = data['titles'].split('|')
+        stored = set()
+        size = 0
+        try:
+            if 'json' in body.info().get('Content-Type', ''):
+                # errors still come as JSON
+                response = json.loads(body.read())
+                print 'error: export failed: %s' % response['error']['info']
+                sys.exit(1)
+            with self.metadir.batch():
+                for page in mw.dump.iter_pages(body):
+                    if mw.dump.store_page(self.metadir, page):
+                        self.cloned += 1
+                    else:
+                        self.skipped += 1
+                    stored.add(page['title'])
+                    size += len(page['text'])
+        except (socket.error, httplib.HTTPException,
+                mw.dump.ParseError), e:
+            batcher.failed([title for title in titles
+                            if title not in stored], e)
+        else:
+            batcher.finished(titles, time.time() - body.start, size)
+        finally:
+            body.close()
+
+
+class ImportCommand(CommandBase):
+
+    name = 'import'
+    description = 'add pages to repo from an XML dump of the wiki'
+    usage = '[options] DUMP'
+
+    # page records written per transaction
+    batch_size = 1000
+
+    def __init__(self):
+        CommandBase.__init__(self)
+        self.parser.add_option('-n', '--namespace', dest='namespaces',
+                               type='int', action='append', metavar='NS',
+                               help='only import pages of namespace NS, may '
+                               'be given more than once')
+        self.parser.add_option('-t', '--title', dest='patterns',
+                               action='append', metavar='PATTERN',
+                               help='only import pages whose title matches '
+                               'the shell-style PATTERN, may be given more '
+                               'than once')
+
+    def _do_command(self):
+        self._die_if_no_init()
+        if len(self.args) != 1:
+            self.parser.error('must have one dump file')
+        import mw.dump
+        namespaces = self.options.namespaces
+        patterns = [pattern.decode('utf-8')
+                    for pattern in self.options.patterns or []]
+        # only an empty repo, or one that was fully pulled, can be caught
+        # up with pull --changed afterwards
+        last_sync = self.metadir.get_last_sync()
+        keep_sync = last_sync is not None or not self.metadir.pagenames()
+        imported = skipped = current = 0
+        latest = None
+        fd = mw.dump.open_dump(self.args[0])
+        try:
+            pages = mw.dump.iter_pages(fd)
+            with mw.timing.phase('import'):
+                while True:
+                    done = True
+                    with self.metadir.batch():
+                        for page in pages:
+                            if namespaces and page['ns'] not in namespaces:
+                                continue
+                            if patterns and not self._matches(page['title'],
+                                                              patterns):
+                                continue
+                            if latest is None or page['timestamp'] > latest:
+                                latest = page['timestamp']
+                            title = page['title']
+                            if self.metadir.has_page(title) and \
+                               self.metadir.get_revision(title) >= \
+                               page['revid']:
+                                current += 1
+                            elif mw.dump.store_page(self.metadir, page):
+                                imported += 1
+                                if imported % self.batch_size == 0:
+                                    done = False
+                                    break
+                            else:
+                                skipped += 1
+                    if done:
+                        break
+        finally:
+            fd.close()
+        self.metadir.save_index()
+        print '%d pages imported, %d up to date, %d skipped' % \
+              (imported, current, skipped)
+        if keep_sync and latest is not None:
+            if last_sync is None or latest < last_sync:
+                self.metadir.set_last_sync(latest)
+
+    def _matches(self, title, patterns):
+        import fnmatch
+        for pattern in patterns:
+            if fnmatch.fnmatchcase(title, pattern):
+                return True
+        return False
+
+
+class UpgradeCommand(CommandBase):
+
+    name = 'upgrade'
+    description = 'convert repo metadata to the packed format'
+
+    def _do_command(self):
+        self._die_if_no_init()
+        self.metadir.upgrade()
+
+
+class LoginCommand(CommandBase):
+
+    name = 'login'
+    description = 'authenticate with wiki'
 
     def _do_command(self):
         self._die_if_no_init()
@@ -115,8 +367,8 @@ class LoginCommand(CommandBase):
 
 class LogoutCommand(CommandBase):
 
-    def __init__(self):
-        CommandBase.__init__(self, 'logout', 'forget authentication')
+    name = 'logout'
+    description = 'forget authentication'
 
     def _do_command(self):
         self._die_if_no_init()
@@ -128,66 +380,227 @@ class LogoutCommand(CommandBase):
 
 class PullCategoryMembersCommand(CommandBase):
 
+    name = 'pullcat'
+    description = 'add remote pages to repo belonging to the given category'
+    usage = '[options] CATEGORY ...'
+
+    # members are pulled in groups of this many titles as they come in
+    chunk_size = 500
+
     def __init__(self):
-        usage = '[options] PAGENAME ...'
-        CommandBase.__init__(self, 'pullcat', 'add remote pages to repo '
-                             'belonging to the given category', usage)
-        self.query_continue = ''
+        CommandBase.__init__(self)
+        self.parser.add_option('-d', '--depth', dest='depth', type='int',
+                               default=0,
+                               help='also pull members of subcategories '
+                               'down to this many levels (default 0)')
+        self.parser.add_option('-j', '--jobs', dest='jobs', type='int',
+                               default=PullCommand.default_jobs,
+                               help='number of requests to keep in flight '
+                               '(default %d, at most %d)' %
+                               (PullCommand.default_jobs,
+                                PullCommand.max_jobs))
 
     def _do_command(self):
         self._die_if_no_init()
         self._api_setup()
-        pages = []
-        pages += self.args
-        for these_pages in [pages[i:i + 25] for i in range(0, len(pages), 25)]:
+        if self.args == []:
+            self.parser.error('no category given')
+        pull_command = PullCommand()
+        pull_command.metadir = self.metadir
+        pull_command.api = self.api
+        pull_command.api_setup = True
+        pull_command.title_limit = self.title_limit
+        pull_command.options.jobs = self.options.jobs
+        fetched = skipped = saved = 0
+        categories = [category.decode('utf-8') for category in self.args]
+        members = self._members(categories, self.options.depth)
+        for chunk in self._chunks(members):
+            chunk_fetched, chunk_skipped, chunk_saved = \
+                pull_command._pull(chunk)
+            fetched += chunk_fetched
+            skipped += chunk_skipped
+            saved += chunk_saved
+        self.metadir.save_index()
+        print '%d pages pulled, %d up to date (%d bytes not downloaded)' % \
+              (fetched, skipped, saved)
+
+    def _chunks(self, titles):
+        chunk = []
+        for title in titles:
+            chunk.append(title)
+            if len(chunk) == self.chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def _members(self, categories, depth):
+        """
+        Yields the titles of the members of the given categories, one
+        response at a time, following continuations.  Subcategories are
+        walked breadth first down to depth levels.  Every category is only
+        walked once and every title only yielded once.
+        """
+        seen = set()
+        queue = collections.deque()
+        for category in categories:
+            if ':' not in category:
+                category = u'Category:' + category
+            queue.append((category, 0))
+        walked = set()
+        while queue:
+            category, level = queue.popleft()
+            if category in walked:
+                continue
+            walked.add(category)
             data = {
-                'action': 'query',
-                'gcmtitle': '|'.join(these_pages),
-                'generator': 'categorymembers',
-                'gcmlimit': 500
+                    'action': 'query',
+                    'generator': 'categorymembers',
+                    'gcmtitle': category,
+                    'gcmlimit': 'max',
+                    'continue': '',
             }
-        if self.query_continue != '':
-           data['gcmcontinue'] = self.query_continue
-
-        api_call = self.api.call(data)
-        if 'query-continue' in api_call:
-            self.query_continue = api_call['query-continue']['categorymembers']['gcmcontinue']
-        else:
-            self.query_continue = ''
-        if api_call != [] :
- 
-            response = api_call['query']['pages']
-            pull_command = PullCommand()
-            pull_command.args = []
-
-            for pageid in response.keys():
-                 pagename = response[pageid]['title']
-                 pull_command.args += [pagename.encode('utf-8')]
+            while True:
+                response = self.api.call(dict(data))
+                if 'error' in response:
+                    print 'error:          "%s": %s' % \
+                        (category, response['error']['info'])
+                    break
+                pages = response.get('query', {}).get('pages', {})
+                for page in sorted(pages.values(),
+                                   key=lambda page: page['title']):
+                    # namespace 14 holds the categories
+                    if page['ns'] == 14 and level < depth:
+                        queue.append((page['title'], level + 1))
+                    if page['title'] not in seen:
+                        seen.add(page['title'])
+                        yield page['title']
+                if 'continue' not in response:
+                    break
+                data.update(response['continue'])
 
-            pull_command._do_command()
 
-            if self.query_continue != '':
-                 print 'query continue detected - continuing the query'
-                 self._do_command()
+class PullCommand(CommandBase):
 
+    name = 'pull'
+    description = 'add remote pages to repo'
+    usage = '[options] PAGENAME ...'
 
-class PullCommand(CommandBase):
+    default_jobs = 2
+    max_jobs = 8
+    # how long the wiki keeps recent changes, in seconds; MediaWiki does
+    # not tell, so this is Wikimedia's $wgRCMaxAge rather than the longer
+    # default
+    rc_max_age = 30 * 24 * 3600
     
     def __init__(self):
-        usage = '[options] PAGENAME ...'
-        CommandBase.__init__(self, 'pull', 'add remote pages to repo', usage)
+        CommandBase.__init__(self)
+        self.parser.add_option('-j', '--jobs', dest='jobs', type='int',
+                               default=self.default_jobs,
+                               help='number of requests to keep in flight '
+                               '(default %d, at most %d)' %
+                               (self.default_jobs, self.max_jobs))
+        self.parser.add_option('-c', '--changed', dest='changed',
+                               action='store_true', default=False,
+                               help='only pull tracked pages that changed '
+                               'on the wiki since the last full pull')
+        self.parser.add_option('--resume', dest='resume',
+                               action='store_true', default=False,
+                               help='continue a pull that was interrupted')
+        # other commands run pulls without parsing a command line
+        self.options = self.parser.get_default_values()
+        # tracked pages that are known to be behind the wiki
+        self.behind = set()
 
     def _do_command(self):
         self._die_if_no_init()
         self._api_setup()
-        pages = []
-        pages += self.args
+        import mw.journal
+        # revision checks of large repos take many batches, the journal is
+        # not rewritten after every one of them
+        journal = mw.journal.Journal(self.metadir, 'pull', interval=1)
+        if self.options.resume:
+            if self.options.changed or self.args:
+                self.parser.error('--resume does not take page names or '
+                                  '--changed')
+            if journal.load() is None:
+                print 'no interrupted pull to resume'
+                return
+            pages = journal.state['pages']
+            sync_time = journal.state['sync_time']
+            self.behind = set(journal.state['behind'])
+        else:
+            pages = []
+            pages += self.args
+            if self.options.changed and pages:
+                self.parser.error('--changed does not take page names')
+
+            # a pull of every tracked page brings the repo up to date as of
+            # now, but for the pages it has to leave behind
+            sync_time = None
+            if pages == []:
+                sync_time = self._server_time()
+            self.behind = set(self.metadir.get_pages_behind())
+            if self.options.changed:
+                last_sync = self.metadir.get_last_sync()
+                if last_sync is None:
+                    print 'no previous full pull recorded -- pulling ' \
+                          'everything'
+                elif self._age(last_sync, sync_time) > self.rc_max_age:
+                    # recent changes would miss the older edits
+                    print 'last full pull at %s is older than the wiki ' \
+                          'keeps recent changes -- pulling everything' % \
+                          last_sync
+                else:
+                    pages = self._changed_pages(last_sync)
+                    # the ones earlier pulls left behind are tried again
+                    tracked = set(self.metadir.pagenames())
+                    pages += sorted([pagename for pagename in self.behind
+                                     if pagename in tracked and
+                                     pagename not in pages])
+                    if pages == []:
+                        print 'nothing changed since %s' % last_sync
+                        self.metadir.set_last_sync(sync_time)
+                        return
+            journal.start({
+                    'pages': pages,
+                    'sync_time': sync_time,
+                    'checked': [],
+                    'stale': {},
+                    'behind': sorted(self.behind),
+            })
 
+        try:
+            fetched, skipped, saved = self._pull(pages, journal)
+        finally:
+            journal.save()
+        self.metadir.save_index()
+        if skipped:
+            print '%d pages pulled, %d up to date (%d bytes not ' \
+                  'downloaded)' % (fetched, skipped, saved)
+        tracked = set(self.metadir.pagenames())
+        self.metadir.set_pages_behind(sorted([pagename for pagename in
+                                              self.behind
+                                              if pagename in tracked]))
+        if sync_time is not None:
+            self.metadir.set_last_sync(sync_time)
+        journal.finish()
+
+    def _pull(self, pages, journal=None):
+        """
+        Pulls the given pages, all tracked pages if there are none.
+        Returns the number of pages written, the number of pages that were
+        up to date and the size of the contents that were not downloaded.
+        With a journal, the pages checked and written are recorded in it as
+        they are, and what an earlier run recorded is not done again.
+        """
         # Pull should work with pagename, filename, or working directory
         converted_pages = []
         if pages == []:
-            pages = self.metadir.working_dir_status().keys()
+            pages = self.metadir.pagenames()
         for filename in pages:
+            if isinstance(filename, str):
+                filename = filename.decode('utf-8')
             if '.wiki' in filename:
                 converted_pages.append(
                     self.metadir.get_pagename_from_filename(filename))
@@ -195,67 +608,334 @@ class PullCommand(CommandBase):
                 converted_pages.append(filename)
         pages = converted_pages
 
-        # process the files in groups of 25 to be kind to service
-        for these_pages in [pages[i:i + 25] for i in 
-                range(0, len(pages), 25)]: 
-            data = {
-                    'action': 'query',
-                    'titles': '|'.join(these_pages),
-                    'prop': 'info|revisions',
-                    'rvprop': 'ids|flags|timestamp|user|comment|content',
-            }
-            response = self.api.call(data)['query']['pages']
-            # for every pageid, returns dict.keys() = {'lastrevid', 'pageid', 'title', 'counter', 'length', 'touched': u'2011-02-02T19:32:04Z', 'ns', 'revisions' {...}}
-            for pageid in response.keys():
-                pagename = response[pageid]['title']
-                
-                if 'revisions' not in response[pageid]:
-                    print 'skipping:       "%s" -- cannot find page, perhaps deleted' % (pagename)
-                    continue
-                
-                # ['revisions'][0] is the latest revid
-                if 'comment' in response[pageid]['revisions'][0]:
-                    last_wiki_rev_comment = response[pageid]['revisions'][0]['comment']
+        # one status snapshot of the pages being pulled, kept up to date
+        # as files are written
+        status = self._working_status([
+            os.path.join(self.metadir.root,
+                         self.metadir.get_filename_from_pagename(pagename))
+            for pagename in pages])
+
+        # clean pages we have a revision of are only downloaded if the
+        # wiki has a newer one
+        known = []
+        for pagename in pages:
+            filename = os.path.join(self.metadir.root,
+                self.metadir.get_filename_from_pagename(pagename))
+            if filename in status and status[filename] is None:
+                known.append(pagename)
+        with mw.timing.phase('pull: revision check'):
+            stale, skipped, saved = self._stale_pages(known, journal)
+        known = set(known)
+        pages = [pagename for pagename in pages if pagename not in known]
+        pages += stale
+
+        # start with groups of 25 to be kind to service, the batcher
+        # adjusts that to how the wiki copes
+        batcher = mw.batcher.Batcher(self.api, pages,
+                                     self._content_request,
+                                     self._title_limit())
+        fetched = 0
+        with mw.timing.phase('pull: download'):
+            for data, response in self._fetch(batcher, batcher.call):
+                with mw.timing.phase('pull: write'):
+                    with self.metadir.batch():
+                        written = self._write_pages(
+                            response['query']['pages'], status)
+                fetched += written
+                if journal is not None:
+                    # not to be checked or downloaded again
+                    journal.state['checked'].extend(data['titles'].split('|'))
+                    journal.state['behind'] = sorted(self.behind)
+                    journal.checkpoint()
+        for pagename in batcher.too_large:
+            print 'skipping:       "%s" -- too large for an API response' \
+                % pagename
+            if self.metadir.has_page(pagename):
+                self.behind.add(pagename)
+        return fetched, skipped, saved
+
+    def _stale_pages(self, pages, journal=None):
+        """
+        Compares the latest revision ids of pages on the wiki with the ones
+        we have, using prop=info queries that do not carry any content.
+        Returns the pages that are behind, the number of pages that are
+        not, and the size of the contents that need not be downloaded.
+        """
+        clean = pages
+        if journal is not None:
+            checked = set(journal.state['checked'])
+            pages = [pagename for pagename in pages
+                     if pagename not in checked]
+        limit = self._title_limit()
+        batcher = mw.batcher.Batcher(self.api, pages, self._info_request,
+                                     limit, size=limit)
+        stale = []
+        skipped = 0
+        saved = 0
+        for data, response in self._fetch(batcher, batcher.call):
+            revisions = {}
+            for page in response['query']['pages'].values():
+                pagename = page['title']
+                if 'missing' not in page and \
+                   self.metadir.has_page(pagename) and \
+                   self.metadir.get_revision(pagename) == page['lastrevid']:
+                    skipped += 1
+                    saved += page.get('length', 0)
+                    self.behind.discard(pagename)
                 else:
-                    last_wiki_rev_comment = ''
-                last_wiki_rev_user = response[pageid]['revisions'][0]['user']
-                
-                # check if working file is modified or if wiki page doesn't exists
-                status = self.metadir.working_dir_status()
-                filename = self.metadir.get_filename_from_pagename(pagename)
-                full_filename = os.path.join(self.metadir.root, filename)
-                if full_filename in status and status[full_filename] in ['M']:
-                    print 'skipping:       "%s" -- uncommitted modifications ' % (pagename)
-                    continue
-                if full_filename in status and status[full_filename] in ['A','?']:
-                    print 'skipping:       "%s" -- uncommitted file exists ' % (pagename)
+                    stale.append(pagename)
+                    revisions[pagename] = page.get('lastrevid', 0)
+            if journal is not None:
+                # pages are only checked once they are known to be behind
+                journal.state['stale'].update(revisions)
+                journal.state['checked'].extend(data['titles'].split('|'))
+                journal.checkpoint()
+        if journal is not None:
+            # pages found behind by an earlier run that were not written
+            # before it stopped
+            stale = []
+            behind = journal.state['stale']
+            for pagename in clean:
+                # missing pages have no revision, they are asked for again
+                if pagename in behind and \
+                   (self.metadir.get_revision(pagename) < behind[pagename] or
+                    not behind[pagename]):
+                    stale.append(pagename)
+            journal.save()
+        return stale, skipped, saved
+
+    def _info_request(self, titles):
+        return {
+                'action': 'query',
+                'titles': '|'.join(titles),
+                'prop': 'info',
+        }
+
+    def _content_request(self, titles):
+        return {
+                'action': 'query',
+                'titles': '|'.join(titles),
+                'prop': 'info|revisions',
+                'rvprop': 'ids|flags|timestamp|user|comment|content',
+        }
+
+    def _server_time(self):
+        response = self.api.call({'action': 'query', 'curtimestamp': 1})
+        if 'curtimestamp' in response:
+            return response['curtimestamp']
+        # older wikis do not tell, hope our clock is not ahead of theirs
+        return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+
+    def _age(self, since, now):
+        """
+        Returns the seconds between two wiki timestamps.
+        """
+        import calendar
+        since, now = [calendar.timegm(time.strptime(timestamp,
+                                                    '%Y-%m-%dT%H:%M:%SZ'))
+                      for timestamp in [since, now]]
+        return now - since
+
+    def _changed_pages(self, since):
+        """
+        Pages through the recent changes since the given timestamp and
+        returns the tracked pages that have a newer revision than the one
+        we have.  Deletions and moves of tracked pages are reported.
+        """
+        tracked = set(self.metadir.pagenames())
+        latest = {}
+        data = {
+                'action': 'query',
+                'list': 'recentchanges',
+                'rcstart': since,
+                'rcdir': 'newer',
+                'rcprop': 'title|ids|timestamp|loginfo',
+                'rctype': 'edit|new|log',
+                'rclimit': 'max',
+                'continue': '',
+        }
+        while True:
+            response = self.api.call(dict(data))
+            for change in response['query']['recentchanges']:
+                title = change['title']
+                if title not in tracked:
                     continue
-                if 'missing' in response[pageid].keys():
-                    print 'error:          "%s": -- page does not exist, file not created' % \
-                            (self.me, pagename)
+                if change['type'] in ['edit', 'new']:
+                    latest[title] = max(latest.get(title, 0),
+                                        change['revid'])
+                elif change.get('logtype') == 'delete' and \
+                     change.get('logaction') == 'delete':
+                    print 'deleted:        "%s" -- page was deleted on ' \
+                          'the wiki' % title
+                elif change.get('logtype') == 'move':
+                    params = change.get('logparams', change.get('move', {}))
+                    target = params.get('target_title',
+                                        params.get('new_title', '?'))
+                    print 'moved:          "%s" -- page was moved to "%s"' \
+                          % (title, target)
+            if 'continue' not in response:
+                break
+            data.update(response['continue'])
+        pages = []
+        for title in sorted(latest):
+            revision = self.metadir.get_revision(title)
+            if revision is not None and latest[title] > revision:
+                pages.append(title)
+        return pages
+
+    def _fetch(self, requests, call=None):
+        """
+        Sends API requests from a pool of worker threads, keeping up to
+        --jobs of them in flight, and yields (request, response) pairs in
+        the order they complete.  Responses are handled in the calling
+        thread, so working files and metadata are only written from there.
+        Requests are sent with call, self.api.call by default; requests it
+        returns None for are left out.
+        """
+        if call is None:
+            call = self.api.call
+        jobs = max(1, min(self.options.jobs, self.max_jobs))
+        requests = iter(requests)
+        if jobs == 1:
+            for data in requests:
+                response = call(data)
+                if response is not None:
+                    yield data, response
+            return
+        todo = Queue.Queue()
+        done = Queue.Queue()
+
+        def work():
+            while True:
+                data = todo.get()
+                if data is None:
+                    return
+                try:
+                    done.put((data, call(data), None))
+                except Exception:
+                    done.put((data, None, sys.exc_info()))
+
+        workers = [threading.Thread(target=work) for i in range(jobs)]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+        in_flight = 0
+        finished = False
+        try:
+            for data in requests:
+                todo.put(data)
+                in_flight += 1
+                if in_flight == jobs:
+                    break
+            while in_flight:
+                try:
+                    # a timeout keeps the wait interruptible by ^C
+                    data, response, error = done.get(True, 1)
+                except Queue.Empty:
                     continue
-
-                wiki_revids = sorted([x['revid'] for x in response[pageid]['revisions']])
-                last_wiki_revid = wiki_revids[-1]
-                print 'pulling:        "%s" : "%s" by "%s"' % (
-                    pagename, last_wiki_rev_comment, last_wiki_rev_user)
-                self.metadir.set_content(pagename,
-                                         response[pageid]['revisions'][0]['*'],
-                                         last_wiki_rev_user,
-                                         last_wiki_revid,
-                                         os.path.relpath(full_filename,
-                                                         self.metadir.root))
-                with file(full_filename, 'w') as fd:
-                    data = response[pageid]['revisions'][0]['*']
-                    data = data.encode('utf-8')
-                    fd.write(data)
+                in_flight -= 1
+                if error is not None:
+                    raise error[0], error[1], error[2]
+                for next_data in requests:
+                    todo.put(next_data)
+                    in_flight += 1
+                    if in_flight == jobs:
+                        break
+                if response is not None:
+                    yield data, response
+            finished = True
+        finally:
+            for worker in workers:
+                todo.put(None)
+            # after ^C or an error, requests still in flight could hold
+            # us up until they time out; the workers are daemon threads
+            if finished:
+                for worker in workers:
+                    worker.join()
+
+    def _write_pages(self, response, status):
+        """
+        Writes the pages of a query response to the working directory and
+        the metadir, returns how many were written.
+        """
+        written = 0
+        # for every pageid, returns dict.keys() = {'lastrevid', 'pageid', 'title', 'counter', 'length', 'touched': u'2011-02-02T19:32:04Z', 'ns', 'revisions' {...}}
+        for pageid in response.keys():
+            pagename = response[pageid]['title']
+            
+            if 'revisions' not in response[pageid]:
+                print 'skipping:       "%s" -- cannot find page, perhaps deleted' % (pagename)
+                continue
+            
+            # ['revisions'][0] is the latest revid
+            if 'comment' in response[pageid]['revisions'][0]:
+                last_wiki_rev_comment = response[pageid]['revisions'][0]['comment']
+            else:
+                last_wiki_rev_comment = ''
+            last_wiki_rev_user = response[pageid]['revisions'][0]['user']
+            
+            # check if working file is modified or if wiki page doesn't exists
+            filename = self.metadir.get_filename_from_pagename(pagename)
+            full_filename = os.path.join(self.metadir.root, filename)
+            if full_filename not in status:
+                # the wiki normalized the title we asked for
+                status.update(self._working_status([full_filename]))
+            if status.get(full_filename) in ['M', '?'] and \
+               mw.metadir.hash_file(full_filename) == \
+               mw.metadir.text_hash(response[pageid]['revisions'][0]['*']):
+                # written by a pull that stopped before it was recorded
+                status[full_filename] = None
+            wiki_revids = sorted([x['revid'] for x in response[pageid]['revisions']])
+            last_wiki_revid = wiki_revids[-1]
+            if full_filename in status and status[full_filename] in ['M']:
+                print 'skipping:       "%s" -- uncommitted modifications ' % (pagename)
+                if self.metadir.get_revision(pagename) < last_wiki_revid:
+                    self.behind.add(pagename)
+                else:
+                    self.behind.discard(pagename)
+                continue
+            if full_filename in status and status[full_filename] in ['A','?']:
+                print 'skipping:       "%s" -- uncommitted file exists ' % (pagename)
+                continue
+            if 'missing' in response[pageid].keys():
+                print 'error:          "%s": -- page does not exist, file not created' % \
+                        (self.me, pagename)
+                continue
+
+            print 'pulling:        "%s" : "%s" by "%s"' % (
+                pagename, last_wiki_rev_comment, last_wiki_rev_user)
+            content = response[pageid]['revisions'][0]['*']
+            digest = mw.metadir.write_page(full_filename, content)
+            self.metadir.set_content(pagename, content,
+                                     last_wiki_rev_user,
+                                     last_wiki_revid,
+                                     os.path.relpath(full_filename,
+                                                     self.metadir.root),
+                                     digest)
+            self.metadir.refresh_index(full_filename)
+            status[full_filename] = None
+            self.behind.discard(pagename)
+            written += 1
+        return written
+
+    def _working_status(self, filenames):
+        """
+        Returns the status of those of filenames that a full
+        working_dir_status would report, i.e. existing or tracked files.
+        """
+        check = [filename for filename in filenames
+                 if os.path.exists(filename) or self.metadir.has_page(
+                     self.metadir.get_pagename_from_filename(filename))]
+        if not check:
+            return {}
+        return self.metadir.working_dir_status(check)
 
 
 class RevertCommand(CommandBase):
 
-    def __init__(self):
-        usage = 'FILES'
-        CommandBase.__init__(self, 'revert', 'revert pages', usage)
+    name = 'revert'
+    description = 'revert pages'
+    usage = 'FILES'
 
     def _do_command(self):
         self._die_if_no_init()
@@ -275,27 +955,61 @@ class RevertCommand(CommandBase):
 
 class StatusCommand(CommandBase):
 
+    name = 'status'
+    description = 'check repo status'
+    shortcuts = ['st']
+
     def __init__(self):
-        CommandBase.__init__(self, 'status', 'check repo status')
-        self.shortcuts.append('st')
+        CommandBase.__init__(self)
         self.parser.add_option('-A', '--all', dest='show_all', action='store_true',
                                 default = False,
                                 help="show all files' status")
+        self._add_jobs_option()
 
     def _do_command(self):
         self._die_if_no_init()
-        status = self.metadir.working_dir_status()
+        status = self.metadir.working_dir_status(jobs=self.options.jobs)
         for filename in sorted(status.keys()):
             stat = status[filename]
             if stat is not None:
                 print '%s %s' % (stat, os.path.relpath(filename))
 
 
-class AddCommand(CommandBase):
+class WatchCommand(CommandBase):
+
+    name = 'watch'
+    description = 'keep repo status up to date in the background'
 
     def __init__(self):
-        usage = 'FILES'
-        CommandBase.__init__(self, 'add', 'add a wiki page', usage)
+        CommandBase.__init__(self)
+        self.parser.add_option('--stop', action='store_true', default=False,
+                               help='stop watching')
+        self.parser.add_option('-f', '--foreground', action='store_true',
+                               default=False,
+                               help='do not go into the background')
+
+    def _do_command(self):
+        self._die_if_no_init()
+        import mw.watch
+        if self.options.stop:
+            if not mw.watch.stop(self.metadir):
+                print '%s: not watching %s' % (self.me, self.metadir.root)
+                sys.exit(1)
+            return
+        try:
+            pid = mw.watch.start(self.metadir, self.options.foreground)
+        except OSError, e:
+            print '%s: %s' % (self.me, e.strerror)
+            sys.exit(1)
+        if not self.options.foreground:
+            print 'watching %s (pid %d)' % (self.metadir.root, pid)
+
+
+class AddCommand(CommandBase):
+
+    name = 'add'
+    description = 'add a wiki page'
+    usage = 'FILES'
 
     def _do_command(self):
         self._die_if_no_init()
@@ -303,7 +1017,7 @@ class AddCommand(CommandBase):
         for filename,stat in status.iteritems():
             if stat == '?':
                 pagename = self.metadir.get_pagename_from_filename(filename)
-                if os.path.exists(self.metadir.get_pagefile_from_pagename(pagename)):
+                if self.metadir.has_page(pagename):
                     print 'warning: can not add %s, page with the same ' \
                           'name exists -- skipping' % filename
                     continue
@@ -312,9 +1026,9 @@ class AddCommand(CommandBase):
 
 
 class CleanCommand(CommandBase):
- 
-    def __init__(self):
-        CommandBase.__init__(self, 'clean', 'remove metadata of deleted pages')
+
+    name = 'clean'
+    description = 'remove metadata of deleted pages'
 
     def _do_command(self):
         self._die_if_no_init()
@@ -322,16 +1036,15 @@ class CleanCommand(CommandBase):
         for filename,stat in status.iteritems():
             if stat == '!':
                 pagename = self.metadir.get_pagename_from_filename(filename)
-                pagefile = self.metadir.get_pagefile_from_pagename(pagename)
-                os.unlink(pagefile)
+                self.metadir.remove_page(pagename)
+        self.metadir.prune_objects()
 
 
 class TouchCommand(CommandBase):
 
-    def __init__(self):
-        usage = 'PAGENAMES'
-        CommandBase.__init__(self, 'touch',
-                             'create files for given page names and add them', usage)
+    name = 'touch'
+    description = 'create files for given page names and add them'
+    usage = 'PAGENAMES'
 
     def _do_command(self):
         self._die_if_no_init()
@@ -347,23 +1060,31 @@ class TouchCommand(CommandBase):
 
 class DiffCommand(CommandBase):
 
+    name = 'diff'
+    description = 'diff wiki to working directory'
+
     def __init__(self):
-        CommandBase.__init__(self, 'diff', 'diff wiki to working directory')
+        CommandBase.__init__(self)
+        self._add_jobs_option()
 
     def _do_command(self):
         self._die_if_no_init()
-        status = self.metadir.working_dir_status()
-        for filename,stat in status.iteritems():
-            if stat in ['M']:
-                print self.metadir.diff_rv_to_working(filename)
+        status = self.metadir.working_dir_status(jobs=self.options.jobs)
+        modified = [filename for filename in sorted(status.keys())
+                    if status[filename] in ['M']]
+        for diff in self.metadir.diffs(modified, self.options.jobs):
+            print diff
 
 
 class CommitCommand(CommandBase):
 
+    name = 'commit'
+    description = 'commit changes to wiki'
+    usage = '[FILES]'
+    shortcuts = ['ci']
+
     def __init__(self):
-        usage = '[FILES]'
-        CommandBase.__init__(self, 'commit', 'commit changes to wiki', usage)
-        self.shortcuts.append('ci')
+        CommandBase.__init__(self)
         self.parser.add_option('-m', '--message', dest='edit_summary',
                                help='don\'t prompt for edit summary and '
                                'use this instead')
@@ -374,124 +1095,409 @@ class CommitCommand(CommandBase):
         self.parser.add_option('-w', '--watch', dest='watch',
                                action='store_true',
                                help='watch modified pages', default=False)
+        self.parser.add_option('--resume', dest='resume',
+                               action='store_true', default=False,
+                               help='continue a commit that was interrupted, '
+                               'with the same edit summary')
+        self._add_jobs_option()
 
     def _do_command(self):
         self._die_if_no_init()
         self._api_setup()
-        files_to_commit = 0 # how many files to process
-        status = self.metadir.working_dir_status(files=self.args)
-        for filename,stat in status.iteritems():
-            if stat in ['A','M']:
-                print '%s %s' % (stat, filename)
-                files_to_commit += 1
-        if not files_to_commit:
-            print 'nothing to commit'
-            sys.exit()
-        if self.options.edit_summary == None:
-            print 'Edit summary:',
-            edit_summary = raw_input()
+        import mw.journal
+        # the journal refers to files relative to the repo root, so the
+        # repo may be moved or resumed from a subdirectory
+        journal = mw.journal.Journal(self.metadir, 'commit')
+        if self.options.resume:
+            if self.args:
+                self.parser.error('--resume does not take files')
+            if journal.load() is None:
+                print 'no interrupted commit to resume'
+                return
+            edit_summary = journal.state['summary']
+            self.options.bot = journal.state['bot']
+            self.options.watch = journal.state['watch']
+            self.scheduler = self._scheduler()
+            self.edittoken = self._edit_token()
         else:
-            edit_summary = self.options.edit_summary
-        for filename,stat in status.iteritems():
-            if stat in ['A','M']:
-                start_time = time.time()
+            edit_summary, pending = self._prepare()
+            journal.start({
+                    'summary': edit_summary,
+                    'bot': self.options.bot,
+                    'watch': self.options.watch,
+                    'pending': [[os.path.relpath(filename, self.metadir.root),
+                                 stat] for filename, stat in pending],
+                    'done': [],
+                    'committed': {},
+            })
+        # edits sent before the commit was interrupted are not sent again,
+        # but still have to be recorded
+        done = set(journal.state['done'])
+        pending = [(os.path.join(self.metadir.root, filename), stat)
+                   for filename, stat in journal.state['pending']
+                   if filename not in done]
+        committed = {}
+        for title, entry in journal.state['committed'].iteritems():
+            filename, revid, digest = entry
+            filename = os.path.join(self.metadir.root, filename)
+            text = mw.metadir.read_working(filename)
+            if mw.metadir.content_hash(text) != digest:
+                # changed again since, only the revision can be recorded
+                text = None
+            committed[title] = (filename, revid, text)
+        files_to_commit = len(pending)
+        try:
+            for filename,stat in pending:
                 files_to_commit -= 1
-                # get edit token
-                data = {
-                        'action': 'query',
-                        'prop': 'info|revisions',
-                        'intoken': 'edit',
-                        'titles': self.metadir.get_pagename_from_filename(filename),
-                }
-                response = self.api.call(data)
-                pages = response['query']['pages']
-                pageid = pages.keys()[0]
-                if stat in ['M']:
-                    revid = pages[pageid]['revisions'][0]['revid']
-                    awaitedrevid = \
-                        self.metadir.get_revision(self.metadir.get_pagename_from_filename(filename))
-                    if revid != awaitedrevid:
-                        print 'warning: edit conflict detected on "%s" (%s -> %s) ' \
-                                '-- skipping! (try pull first)' % (filename, awaitedrevid, revid)
-                        continue
-                edittoken = pages[pageid]['edittoken']
+                pagename = self.metadir.get_pagename_from_filename(filename)
                 full_filename = os.path.join(self.metadir.root, filename)
-                text = codecs.open(full_filename, 'r', 'utf-8').read()
-                text = text.encode('utf-8')
-                if (len(text) != 0) and (text[-1] == '\n'):
-                    text = text[:-1]
+                text = mw.metadir.read_working(full_filename)
                 md5 = hashlib.md5()
                 md5.update(text)
                 textmd5 = md5.hexdigest()
                 data = {
                         'action': 'edit',
-                        'title': self.metadir.get_pagename_from_filename(filename),
-                        'token': edittoken,
+                        'title': pagename,
+                        'token': self.edittoken,
                         'text': text,
                         'md5': textmd5,
                         'summary': edit_summary,
                 }
+                # the wiki refuses the edit if the page changed since the
+                # revision check, which may have been long ago
+                if stat in ['M']:
+                    data['baserevid'] = self.metadir.get_revision(pagename)
+                else:
+                    data['createonly'] = 1
                 if self.options.bot:
                     data['bot'] = 'bot'
                 if self.options.watch:
                     data['watchlist'] = 'watch'
-                response = self.api.call(data)
+                with mw.timing.phase('commit: edit'):
+                    response = self._edit(data)
+                if response is None:
+                    continue
                 if 'error' in response:
-                    if 'code' in response['error']:
-                        if response['error']['code'] == 'permissiondenied':
-                            print 'Permission denied -- try running "mw login"'
-                            return
+                    code = response['error'].get('code')
+                    if code == 'permissiondenied':
+                        print 'Permission denied -- try running "mw login"'
+                        return
+                    revid = None
+                    if code == 'articleexists' and self.options.resume:
+                        # the page may have been created just before the
+                        # commit was interrupted
+                        revid = self._saved(pagename, text)
+                    if revid is not None:
+                        committed[pagename] = (filename, revid, text)
+                        self._checkpoint(journal, filename, pagename, revid,
+                                         text)
+                        continue
+                    if code == 'editconflict':
+                        print 'warning: edit conflict detected on "%s" ' \
+                              '-- skipping! (try pull first)' % filename
+                    elif code == 'articleexists':
+                        print 'warning: "%s" was created on the wiki ' \
+                              'meanwhile -- skipping! (try pull first)' % \
+                              filename
+                    else:
+                        print 'error: committing %s failed: %s' % \
+                              (filename, response['error'].get('info', code))
+                    self._checkpoint(journal, filename)
+                    continue
                 if response['edit']['result'] == 'Success':
+                    if 'nochange' in response['edit'] and self.options.resume:
+                        # the edit may have been saved just before the
+                        # commit was interrupted, so the wiki's current
+                        # revision is recorded
+                        title = response['edit']['title']
+                        revid = self._lastrevids([title]).get(title)
+                        committed[title] = (filename, revid, text)
+                        self._checkpoint(journal, filename, title, revid,
+                                         text)
+                        continue
                     if 'nochange' in response['edit']:
                         print 'warning: no changes detected in %s - ' \
                                 'skipping and removing ending LF' % filename
                         self.metadir.clean_page(filename)
+                        self._checkpoint(journal, filename)
                         continue
-                    if stat in ['M'] and response['edit']['oldrevid'] != revid:
-                        print 'warning: edit conflict detected on %s (%s -> %s) ' \
-                                '-- skipping!' % (file, 
-                                response['edit']['oldrevid'], revid)
-                        continue
-                    data = {
-                            'action': 'query',
-                            'revids': response['edit']['newrevid'],
-                            'prop': 'info|revisions',
-                            'rvprop':
-                                    'ids|flags|timestamp|user|comment|content',
-                    }
-                    response = self.api.call(data)['query']['pages']
-                    pageid = response.keys()[0]
-                    # need to write latest rev to file too, as text may be changed
-                    #such as a sig, e.g., -~ =>  -[[User:Reagle|Reagle]]
-                    pagename = self.metadir.get_pagename_from_filename(filename)
-                    self.metadir.set_content(pagename,
-                                             response[pageid]['revisions'][0]['*'],
-                                             response[pageid]['revisions'][0]['user'],
-                                             response[pageid]['revisions'][0]['revid'],
-                                             os.path.relpath(filename,self.metadir.root))
-                    with file(filename, 'w') as fd:
-                        data = response[pageid]['revisions'][0]['*']
-                        data = data.encode('utf-8')
-                        fd.write(data)
+                    # the new revisions are recorded in one go once all edits
+                    # are sent, see _refresh(); if the wiki merged our edit
+                    # with a newer one, the merged text is downloaded there
+                    committed[response['edit']['title']] = \
+                            (filename, response['edit']['newrevid'], text)
+                    self._checkpoint(journal, filename,
+                                     response['edit']['title'],
+                                     response['edit']['newrevid'], text)
                     if files_to_commit :
-                        end_time = time.time()
                         print time.strftime("%Y-%m-%d - %H:%M:%S", time.gmtime(time.time())) \
                             + " - Committed - " + self.metadir.get_pagename_from_filename(filename) \
                             + " - Files left: " + str(files_to_commit)
-                        time_inc = end_time - start_time
-                        delay = 10 - time_inc
-                        if delay > 0 :
-                            print "adjusting throttle - waiting for %.2fs" % delay
-                            time.sleep(delay) 
                 else:
                     print 'error: committing %s failed: %s' % \
                             (filename, response['edit']['result'])
+                    self._checkpoint(journal, filename)
+        finally:
+            with mw.timing.phase('commit: refresh'):
+                self._refresh(committed)
+            self.metadir.save_index()
+            journal.state['committed'] = {}
+            journal.save()
+        journal.finish()
+        if self.scheduler.throttled:
+            print 'throttled for %.2fs in total' % self.scheduler.throttled
+
+    def _prepare(self):
+        """
+        Lists the files to commit and asks for the edit summary.  Returns
+        the summary and the (filename, status) pairs of the files that are
+        not in conflict.
+        """
+        files_to_commit = 0 # how many files to process
+        status = self.metadir.working_dir_status(files=self.args,
+                                                 jobs=self.options.jobs)
+        for filename,stat in status.iteritems():
+            if stat in ['A','M']:
+                print '%s %s' % (stat, filename)
+                files_to_commit += 1
+        if not files_to_commit:
+            print 'nothing to commit'
+            sys.exit()
+        if self.options.edit_summary == None:
+            print 'Edit summary:',
+            edit_summary = raw_input()
+        else:
+            edit_summary = self.options.edit_summary
+        self.scheduler = self._scheduler()
+        # one edit token and one round of revision checks for all files
+        # before anything is sent
+        with mw.timing.phase('commit: revision check'):
+            self.edittoken = self._edit_token()
+            lastrevids = self._lastrevids([
+                self.metadir.get_pagename_from_filename(filename)
+                for filename,stat in status.iteritems() if stat in ['M']])
+        pending = []
+        for filename,stat in status.iteritems():
+            if stat in ['A','M']:
+                pending.append((filename, stat))
+        for filename,stat in list(pending):
+            if stat in ['M']:
+                revid = lastrevids.get(
+                    self.metadir.get_pagename_from_filename(filename))
+                awaitedrevid = \
+                    self.metadir.get_revision(self.metadir.get_pagename_from_filename(filename))
+                if revid != awaitedrevid:
+                    print 'warning: edit conflict detected on "%s" (%s -> %s) ' \
+                            '-- skipping! (try pull first)' % (filename, awaitedrevid, revid)
+                    pending.remove((filename, stat))
+        return edit_summary, pending
+
+    def _scheduler(self):
+        try:
+            return mw.throttle.Scheduler.from_config(self.metadir.config)
+        except ValueError, e:
+            print '%s: %s in .mw/config' % (self.me, e)
+            sys.exit(1)
+
+    def _checkpoint(self, journal, filename, title=None, revid=None,
+                    text=None):
+        """
+        Records in the journal that the edit of filename was sent, and the
+        revision it created, if any, so --resume neither sends nor forgets
+        it.
+        """
+        filename = os.path.relpath(filename, self.metadir.root)
+        journal.state['done'].append(filename)
+        if title is not None:
+            journal.state['committed'][title] = \
+                [filename, revid, mw.metadir.content_hash(text)]
+        journal.save()
+
+    def _refresh(self, committed):
+        """
+        Records the revisions created by a commit.  committed maps page
+        names to the working file, the new revision id and the text that
+        was sent.  Authors and hashes of the revisions are looked up in
+        batches; the content is only downloaded for revisions whose text
+        differs from what was sent, as when the wiki expanded a signature.
+        """
+        limit = self._title_limit()
+        revids = [str(entry[1]) for entry in committed.values()]
+        changed = []
+        with self.metadir.batch():
+            for i in range(0, len(revids), limit):
+                response = self.api.call({
+                    'action': 'query',
+                    'prop': 'revisions',
+                    'revids': '|'.join(revids[i:i + limit]),
+                    'rvprop': 'ids|user|sha1',
+                })
+                for page in response['query']['pages'].values():
+                    filename, revid, text = committed[page['title']]
+                    revision = page['revisions'][0]
+                    if text is None:
+                        changed.append(str(revid))
+                        continue
+                    digest = mw.metadir.content_hash(text)
+                    if revision.get('sha1') == digest:
+                        self._record(filename, text.decode('utf-8'),
+                                     revision, digest)
+                    else:
+                        changed.append(str(revid))
+            while changed:
+                response = self.api.call({
+                    'action': 'query',
+                    'prop': 'revisions',
+                    'revids': '|'.join(changed[:limit]),
+                    'rvprop': 'ids|user|content',
+                })
+                del changed[:limit]
+                for page in response['query']['pages'].values():
+                    filename, revid, text = committed[page['title']]
+                    if 'revisions' not in page:
+                        # left out of a response that grew too large
+                        if limit == 1:
+                            print 'warning: "%s" is too large to download, ' \
+                                  'try pull' % page['title']
+                        else:
+                            changed.append(str(revid))
+                            limit = max(1, limit // 2)
+                        continue
+                    revision = page['revisions'][0]
+                    if text is None:
+                        # the working file keeps the changes made since
+                        self._record(filename, revision['*'], revision)
+                        continue
+                    # the text was changed on save, e.g. a signature like
+                    # -~~~~ became -[[User:Reagle|Reagle]]
+                    digest = mw.metadir.write_page(filename, revision['*'])
+                    self._record(filename, revision['*'], revision, digest)
+
+    def _record(self, filename, content, revision, digest=None):
+        pagename = self.metadir.get_pagename_from_filename(filename)
+        self.metadir.set_content(pagename, content, revision['user'],
+                                 revision['revid'],
+                                 os.path.relpath(filename, self.metadir.root),
+                                 digest)
+        self.metadir.refresh_index(filename)
+
+    def _edit_token(self):
+        response = self.api.call({'action': 'query', 'meta': 'tokens',
+                                  'type': 'csrf'})
+        if 'tokens' in response.get('query', {}):
+            return response['query']['tokens']['csrftoken']
+        # wikis older than MediaWiki 1.24 hand out tokens with page info
+        response = self.api.call({'action': 'query', 'prop': 'info',
+                                  'intoken': 'edit', 'titles': 'Main Page'})
+        return response['query']['pages'].values()[0]['edittoken']
+
+    def _saved(self, pagename, text):
+        """
+        Returns the id of the latest revision of a page if it has the
+        given text, None otherwise.
+        """
+        response = self.api.call({
+                'action': 'query',
+                'titles': pagename,
+                'prop': 'revisions',
+                'rvprop': 'ids|sha1',
+        })
+        for page in response['query']['pages'].values():
+            for revision in page.get('revisions', []):
+                if revision.get('sha1') == mw.metadir.content_hash(text):
+                    return revision['revid']
+        return None
+
+    def _lastrevids(self, pagenames):
+        """
+        Returns the latest revision id of each of the given pages on the
+        wiki, asking for as many of them in one query as the wiki allows.
+        Pages that do not exist are left out.
+        """
+        limit = self._title_limit()
+        batcher = mw.batcher.Batcher(self.api, pagenames,
+                                     lambda titles: {
+                                         'action': 'query',
+                                         'prop': 'info',
+                                         'titles': '|'.join(titles),
+                                     }, limit, size=limit)
+        lastrevids = {}
+        for data in batcher:
+            response = batcher.call(data)
+            if response is None:
+                continue
+            aliases = {}
+            for alias in response['query'].get('normalized', []):
+                aliases[alias['to']] = alias['from']
+            for page in response['query']['pages'].values():
+                if 'missing' in page:
+                    continue
+                lastrevids[page['title']] = page['lastrevid']
+                if page['title'] in aliases:
+                    lastrevids[aliases[page['title']]] = page['lastrevid']
+        return lastrevids
+
+    def _edit(self, data):
+        """
+        Sends an edit once the scheduler allows it, backing off and trying
+        again while the wiki is lagged or rate limits us.  An edit token
+        that went stale is renewed once.  Returns the response, or None if
+        the edit was given up.
+        """
+        if self.scheduler.maxlag:
+            data['maxlag'] = self.scheduler.maxlag
+        import urllib2
+        renewed_token = False
+        while True:
+            delay = self.scheduler.wait()
+            if delay:
+                print "adjusting throttle - waiting for %.2fs" % delay
+            headers = None
+            try:
+                response = self.api.call(dict(data))
+            except urllib2.HTTPError, e:
+                if e.code not in [429, 503]:
+                    raise
+                code = 'HTTP %d' % e.code
+                headers = e.info()
+            else:
+                code = response.get('error', {}).get('code')
+                if code == 'badtoken' and not renewed_token:
+                    self.edittoken = self._edit_token()
+                    data['token'] = self.edittoken
+                    renewed_token = True
+                    continue
+                if code not in ['maxlag', 'ratelimited']:
+                    self.scheduler.success()
+                    return response
+                # these come with status 200 and Retry-After all the same
+                headers = self.api.last_headers()
+            retry_after = None
+            if headers is not None:
+                retry_after = headers.getheader('Retry-After')
+            if retry_after is not None and retry_after.isdigit():
+                retry_after = int(retry_after)
+            elif code == 'maxlag' and 'lag' in response['error']:
+                # without Retry-After, wait at least as long as the lag
+                retry_after = response['error']['lag']
+            else:
+                retry_after = None
+            delay = self.scheduler.backoff(retry_after)
+            if delay is None:
+                print 'error: committing "%s" failed: wiki keeps refusing ' \
+                      'edits (%s)' % (data['title'], code)
+                return None
+            print 'wiki refused edit (%s) -- backing off for %.2fs' % \
+                  (code, delay)
 
 
 class WbcreateclaimCommand(CommandBase):
 
+    name = 'wbcreateclaim'
+    description = 'create claim for wikidata'
+
     def __init__(self):
-        CommandBase.__init__(self, 'wbcreateclaim', 'create claim for wikidata')
+        CommandBase.__init__(self)
         self.parser.add_option('-q', '--entity', dest='entity',
                                help='an entity (target) for new claim')
         self.parser.add_option('-p', '--property', dest='property',
@@ -541,8 +1547,11 @@ class WbcreateclaimCommand(CommandBase):
 
 class Wbsetqualifier(CommandBase):
 
+    name = 'wbsetqualifier'
+    description = 'set qualifier for claim'
+
     def __init__(self):
-        CommandBase.__init__(self, 'wbsetqualifier', 'set qualifier for claim')
+        CommandBase.__init__(self)
         self.parser.add_option('-c', '--claim', dest='claim',
                                help='a claim (target) for qualifier')
         self.parser.add_option('-p', '--property', dest='property',
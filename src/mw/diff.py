@@ -0,0 +1,225 @@
+###
+# mw - VCS-like nonsense for MediaWiki websites
+# Copyright (C) 2011  Ian Weller <ian@ianweller.org> and others
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+###
+
+"""
+Unified diffs of page texts.
+
+Lines are matched with the patience algorithm, the one bzr uses, so the
+output is the same mw printed when it diffed with bzrlib.  Every distinct
+line is numbered once and the matching works on those numbers, which keeps
+comparisons cheap on long pages with long lines.
+"""
+
+import bisect
+import itertools
+
+# lines of context around changes
+context = 3
+
+# how deep matching recurses between unique lines before it gives up on a
+# region, as bzr does
+max_depth = 10
+
+
+def unified_diff(old, new, oldname, newname, n=context):
+    """
+    Yields the unified diff of the byte strings old and new line by line,
+    nothing if they are equal.  A text is a list of lines separated by
+    '\\n', and every line of the diff ends with one.
+    """
+    if old == new:
+        return
+    a = old.split('\n')
+    b = new.split('\n')
+    # equal lines get the number of the first of them
+    numbers = {}
+    a_ids = map(numbers.setdefault, a, xrange(len(a)))
+    b_ids = map(numbers.setdefault, b, xrange(len(a), len(a) + len(b)))
+    numbers = None
+    started = False
+    for group in grouped_opcodes(matching_blocks(a_ids, b_ids), n):
+        if not started:
+            yield '--- %s\n' % oldname
+            yield '+++ %s\n' % newname
+            started = True
+        i1, i2 = group[0][1], group[-1][2]
+        j1, j2 = group[0][3], group[-1][4]
+        yield '@@ -%d,%d +%d,%d @@\n' % (i1 + 1, i2 - i1, j1 + 1, j2 - j1)
+        for tag, i1, i2, j1, j2 in group:
+            if tag == 'equal':
+                for line in a[i1:i2]:
+                    yield ' %s\n' % line
+                continue
+            if tag in ('replace', 'delete'):
+                for line in a[i1:i2]:
+                    yield '-%s\n' % line
+            if tag in ('replace', 'insert'):
+                for line in b[j1:j2]:
+                    yield '+%s\n' % line
+
+
+def unique_lcs(a, b, alo, ahi, blo, bhi):
+    """
+    Returns the longest run of (i, j) pairs, increasing in both, where a[i]
+    equals b[j] and that line occurs exactly once in a[alo:ahi] and once in
+    b[blo:bhi].  It is found by patience sorting.
+    """
+    # a line is unique where its first and last positions are the same
+    a_last = dict(itertools.izip(a[alo:ahi], xrange(alo, ahi)))
+    a_first = dict(itertools.izip(reversed(a[alo:ahi]),
+                                  reversed(xrange(alo, ahi))))
+    b_first = dict(itertools.izip(reversed(b[blo:bhi]),
+                                  reversed(xrange(blo, bhi))))
+    b_last = dict(itertools.izip(b[blo:bhi], xrange(blo, bhi)))
+    btoa = {}
+    for line, j in b_last.iteritems():
+        i = a_last.get(line)
+        if i is not None and a_first[line] == i and b_first[line] == j:
+            btoa[j] = i
+    backpointers = {}
+    stacks = []
+    lasts = []
+    top = -1
+    for j, i in sorted(btoa.iteritems()):
+        # the next line usually comes after all earlier ones
+        if i > top:
+            backpointers[j] = lasts[-1] if lasts else None
+            stacks.append(i)
+            lasts.append(j)
+            top = i
+            continue
+        k = bisect.bisect(stacks, i)
+        backpointers[j] = lasts[k - 1] if k else None
+        stacks[k] = i
+        lasts[k] = j
+        if k == len(stacks) - 1:
+            top = i
+    result = []
+    if lasts:
+        j = lasts[-1]
+        while j is not None:
+            result.append((btoa[j], j))
+            j = backpointers[j]
+        result.reverse()
+    return result
+
+
+def _match(a, b, alo, blo, ahi, bhi, answer, depth):
+    """
+    Appends the (i, j) pairs of matching lines in a[alo:ahi] and
+    b[blo:bhi] to answer.
+    """
+    if depth < 0 or alo == ahi or blo == bhi:
+        return
+    found = len(answer)
+    last_a = alo - 1
+    last_b = blo - 1
+    for i, j in unique_lcs(a, b, alo, ahi, blo, bhi):
+        # match what lies between two unique lines; a single line on both
+        # sides, the most common case, matches when it is the same
+        if last_a + 2 == i and last_b + 2 == j:
+            if depth > 0 and a[i - 1] == b[j - 1]:
+                answer.append((i - 1, j - 1))
+        elif last_a + 1 != i or last_b + 1 != j:
+            _match(a, b, last_a + 1, last_b + 1, i, j, answer, depth - 1)
+        last_a = i
+        last_b = j
+        answer.append((i, j))
+    if len(answer) > found:
+        _match(a, b, last_a + 1, last_b + 1, ahi, bhi, answer, depth - 1)
+    elif a[alo] == b[blo]:
+        # no unique lines, but the region starts alike
+        while alo < ahi and blo < bhi and a[alo] == b[blo]:
+            answer.append((alo, blo))
+            alo += 1
+            blo += 1
+        _match(a, b, alo, blo, ahi, bhi, answer, depth - 1)
+    elif a[ahi - 1] == b[bhi - 1]:
+        # or ends alike
+        nahi = ahi - 1
+        nbhi = bhi - 1
+        while nahi > alo and nbhi > blo and a[nahi - 1] == b[nbhi - 1]:
+            nahi -= 1
+            nbhi -= 1
+        _match(a, b, last_a + 1, last_b + 1, nahi, nbhi, answer, depth - 1)
+        for k in xrange(ahi - nahi):
+            answer.append((nahi + k, nbhi + k))
+
+
+def matching_blocks(a, b):
+    """
+    Returns the (i, j, n) triples of runs of matching lines, a[i:i + n]
+    being equal to b[j:j + n], ending with (len(a), len(b), 0) like
+    difflib.SequenceMatcher.get_matching_blocks.
+    """
+    pairs = []
+    _match(a, b, 0, 0, len(a), len(b), pairs, max_depth)
+    blocks = []
+    start_a = start_b = None
+    length = 0
+    for i, j in pairs:
+        if start_a is not None and i == start_a + length and \
+           j == start_b + length:
+            length += 1
+            continue
+        if start_a is not None:
+            blocks.append((start_a, start_b, length))
+        start_a, start_b, length = i, j, 1
+    if length:
+        blocks.append((start_a, start_b, length))
+    blocks.append((len(a), len(b), 0))
+    return blocks
+
+
+def grouped_opcodes(blocks, n=context):
+    """
+    Turns matching blocks into groups of changes with up to n lines of
+    context around them, the way difflib.SequenceMatcher's
+    get_grouped_opcodes does.
+    """
+    codes = []
+    i = j = 0
+    for ai, bj, size in blocks:
+        if i < ai and j < bj:
+            codes.append(('replace', i, ai, j, bj))
+        elif i < ai:
+            codes.append(('delete', i, ai, j, bj))
+        elif j < bj:
+            codes.append(('insert', i, ai, j, bj))
+        i, j = ai + size, bj + size
+        if size:
+            codes.append(('equal', ai, i, bj, j))
+    if not codes:
+        return
+    tag, i1, i2, j1, j2 = codes[0]
+    if tag == 'equal':
+        codes[0] = tag, max(i1, i2 - n), i2, max(j1, j2 - n), j2
+    tag, i1, i2, j1, j2 = codes[-1]
+    if tag == 'equal':
+        codes[-1] = tag, i1, min(i2, i1 + n), j1, min(j2, j1 + n)
+    group = []
+    for tag, i1, i2, j1, j2 in codes:
+        # a long run of equal lines ends one group and starts the next
+        if tag == 'equal' and i2 - i1 > n * 2:
+            group.append((tag, i1, min(i2, i1 + n), j1, min(j2, j1 + n)))
+            yield group
+            group = []
+            i1, j1 = max(i1, i2 - n), max(j1, j2 - n)
+        group.append((tag, i1, i2, j1, j2))
+    if group and not (len(group) == 1 and group[0][0] == 'equal'):
+        yield group
@@ -0,0 +1,178 @@
+###
+# mw - VCS-like nonsense for MediaWiki websites
+# Copyright (C) 2011  Ian Weller <ian@ianweller.org> and others
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+###
+
+"""
+MediaWiki XML dumps, as written by Special:Export, the API's export module
+and the dump scripts.
+
+Dumps are parsed as they are read and every page is dropped once it has
+been handed out, so a dump of any size takes as much memory as its largest
+page.
+"""
+
+import bz2
+import gzip
+import mw.metadir
+import os
+import xml.etree.cElementTree as ElementTree
+
+# what iter_pages raises for a dump that is cut off or not XML
+ParseError = ElementTree.ParseError
+
+
+def _local(tag):
+    # tags come as {http://www.mediawiki.org/xml/export-0.10/}page
+    return tag.rsplit('}', 1)[-1]
+
+
+def _text(elem):
+    if elem is None or elem.text is None:
+        return u''
+    # cElementTree hands out ASCII text as str
+    return unicode(elem.text)
+
+
+def _child(elem, name):
+    for child in elem:
+        if _local(child.tag) == name:
+            return child
+    return None
+
+
+class _Bz2File(object):
+    """
+    Decompresses a bz2 file as it is read.  Unlike bz2.BZ2File, it goes on
+    past the end of the first stream, as the multistream dumps need.
+    """
+
+    chunk_size = 64 * 1024
+
+    def __init__(self, fd):
+        self.fd = fd
+        self.decompressor = bz2.BZ2Decompressor()
+        self.buffer = ''
+        self.offset = 0
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) - self.offset < size:
+            data = self.fd.read(self.chunk_size)
+            if not data:
+                break
+            chunks = [self.buffer[self.offset:]]
+            while data:
+                try:
+                    chunks.append(self.decompressor.decompress(data))
+                except EOFError:
+                    # the next stream starts right where the last one ended
+                    self.decompressor = bz2.BZ2Decompressor()
+                    chunks.append(self.decompressor.decompress(data))
+                data = self.decompressor.unused_data
+            self.buffer = ''.join(chunks)
+            self.offset = 0
+        if size < 0:
+            size = len(self.buffer) - self.offset
+        data = self.buffer[self.offset:self.offset + size]
+        self.offset += size
+        return data
+
+    def close(self):
+        self.fd.close()
+
+
+def open_dump(filename):
+    """
+    Opens a dump for reading, decompressing it on the fly if it is
+    compressed with bzip2 or gzip.
+    """
+    fd = open(filename, 'rb')
+    magic = fd.read(3)
+    fd.seek(0)
+    if magic == 'BZh':
+        return _Bz2File(fd)
+    if magic[:2] == '\x1f\x8b':
+        return gzip.GzipFile(fileobj=fd, mode='rb')
+    return fd
+
+
+def iter_pages(fd):
+    """
+    Yields the pages of the dump read from the file-like object fd as dicts
+    with the title, ns and id of the page and the revid, timestamp, user,
+    comment and text of its last revision.
+    """
+    root = None
+    page = None
+    for event, elem in ElementTree.iterparse(fd, events=('start', 'end')):
+        tag = _local(elem.tag)
+        if event == 'start':
+            if root is None:
+                root = elem
+            elif tag == 'page':
+                page = {}
+            continue
+        if page is None:
+            continue
+        if tag == 'revision':
+            # dumps with history list older revisions first
+            contributor = _child(elem, 'contributor')
+            user = _child(contributor, 'username')
+            if user is None:
+                user = _child(contributor, 'ip')
+            page['revid'] = int(_text(_child(elem, 'id')))
+            page['timestamp'] = _text(_child(elem, 'timestamp'))
+            page['user'] = _text(user)
+            page['comment'] = _text(_child(elem, 'comment'))
+            page['text'] = _text(_child(elem, 'text'))
+            elem.clear()
+        elif tag == 'page':
+            page['title'] = _text(_child(elem, 'title'))
+            page['ns'] = int(_text(_child(elem, 'ns')) or 0)
+            page['id'] = int(_text(_child(elem, 'id')))
+            if 'revid' in page:
+                yield page
+            page = None
+            root.clear()
+
+
+def store_page(metadir, page):
+    """
+    Writes the working file and the metadata of a page from iter_pages.
+    Returns False, leaving everything as it was, if there is a working file
+    with changes that were not committed.
+    """
+    pagename = page['title']
+    filename = os.path.join(metadir.root,
+                            metadir.get_filename_from_pagename(pagename))
+    if os.path.exists(filename):
+        if not metadir.has_page(pagename):
+            print 'skipping:       "%s" -- uncommitted file exists' % \
+                pagename
+            return False
+        if metadir.is_modified(filename):
+            print 'skipping:       "%s" -- uncommitted modifications' % \
+                pagename
+            return False
+    digest = mw.metadir.write_page(filename, page['text'])
+    metadir.set_content(pagename, page['text'], page['user'], page['revid'],
+                        os.path.relpath(filename, metadir.root), digest)
+    if not page['text'].endswith(u'\n'):
+        # the working file hashes like the content
+        metadir.refresh_index(filename, digest)
+    else:
+        metadir.refresh_index(filename)
+    return True
@@ -0,0 +1,82 @@
+###
+# mw - VCS-like nonsense for MediaWiki websites
+# Copyright (C) 2011  Ian Weller <ian@ianweller.org> and others
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+###
+
+"""
+Progress journals of long running commands, so that they can be resumed
+where they stopped.
+"""
+
+import errno
+import json
+import os
+import time
+
+
+class Journal(object):
+    """
+    Keeps the state of a command, a dict that can be stored as JSON, in
+    .mw/NAME.journal.  The file is replaced by renaming a new one over it,
+    so a crash leaves either the last checkpoint or the one before it.
+    Checkpoints are written at most every interval seconds, save() writes
+    one right away.
+    """
+
+    def __init__(self, metadir, name, interval=0):
+        self.location = os.path.join(metadir.location, name + '.journal')
+        self.interval = interval
+        self.state = None
+        self.saved = 0
+
+    def load(self):
+        """
+        Reads the journal left by an interrupted run, returns its state or
+        None if there is none.
+        """
+        try:
+            with open(self.location) as fd:
+                self.state = json.load(fd)
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+        return self.state
+
+    def start(self, state):
+        self.state = state
+        self.save()
+
+    def checkpoint(self):
+        if time.time() - self.saved >= self.interval:
+            self.save()
+
+    def save(self):
+        tmp_loc = self.location + '.tmp'
+        with open(tmp_loc, 'w') as fd:
+            json.dump(self.state, fd)
+            fd.flush()
+            os.fsync(fd.fileno())
+        os.rename(tmp_loc, self.location)
+        self.saved = time.time()
+
+    def finish(self):
+        """
+        Drops the journal once the command is done.
+        """
+        if os.path.exists(self.location):
+            os.remove(self.location)
+        self.state = None
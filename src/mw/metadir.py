@@ -16,19 +16,39 @@
 # with this program.  If not, see <http://www.gnu.org/licenses/>.
 ###
 
-import bzrlib.diff
-import codecs
 import ConfigParser
+import contextlib
 import json
+import mw.diff
+import mw.pagestore
+import mw.timing
 import os
-from StringIO import StringIO
 import sys
 import hashlib
+import time
 
 version = 'merkys/2'
+packed_version = 'merkys/3'
+
+# metadir versions this code can read, and how they store page records
+stores = {
+    version: mw.pagestore.FilePageStore,
+    packed_version: mw.pagestore.PackedPageStore,
+}
+
+# bytes read, or characters encoded, at a time when handling large pages
+chunk_size = 1024 * 1024
 
 class Metadir(object):
 
+    # files to hash per process before a pool is worth starting, and how
+    # many files a process is handed at a time
+    pool_min_files = 32
+    pool_chunk_size = 64
+
+    # whether working_dir_status asks a running mw watch, see mw.watch
+    use_watcher = True
+
     def __init__(self):
         self.me = os.path.basename(sys.argv[0])
         root = os.getcwd()
@@ -44,17 +64,26 @@ class Metadir(object):
         self.location = os.path.join(self.root, '.mw')
         self.config_loc = os.path.join(self.location, 'config')
         self.version_loc = os.path.join(self.location, 'version')
+        self.index_loc = os.path.join(self.location, 'index')
+        self._index = None
+        self._pagedata = {}
+        # working file hashes computed by a process pool, see _hash_in_pool
+        self._hashed = {}
         if os.path.isdir(self.location) and \
            os.path.isfile(self.config_loc) and \
            os.path.isfile(self.version_loc):
             fd = file(self.version_loc, 'r+')
-            if fd.read() != version:
+            self.version = fd.read()
+            if self.version not in stores:
                 print '%s: mw repo is incompatible' % self.me
                 sys.exit(1)
             fd.close()
+            self.store = stores[self.version](self)
             self.config = ConfigParser.RawConfigParser()
             self.config.read(self.config_loc)
         else:
+            self.version = None
+            self.store = None
             self.config = None
 
     def save_config(self):
@@ -63,7 +92,40 @@ class Metadir(object):
             self.config.write(config_file)
         os.umask(oldmask)
 
-    def create(self, api_url):
+    def get_last_sync(self):
+        """
+        Returns the wiki timestamp of the last full pull, or None.  All
+        tracked pages but those of get_pages_behind were up to date then.
+        """
+        if self.config.has_option('pull', 'last_sync'):
+            return self.config.get('pull', 'last_sync')
+        return None
+
+    def set_last_sync(self, timestamp):
+        if not self.config.has_section('pull'):
+            self.config.add_section('pull')
+        self.config.set('pull', 'last_sync', timestamp)
+        self.save_config()
+
+    def get_pages_behind(self):
+        """
+        Returns the tracked pages that the last pulls left behind the
+        wiki, e.g. because they had local changes.
+        """
+        if self.config.has_option('pull', 'behind'):
+            return json.loads(self.config.get('pull', 'behind'))
+        return []
+
+    def set_pages_behind(self, pagenames):
+        if not self.config.has_section('pull'):
+            self.config.add_section('pull')
+        if pagenames:
+            self.config.set('pull', 'behind', json.dumps(pagenames))
+        else:
+            self.config.remove_option('pull', 'behind')
+        self.save_config()
+
+    def create(self, api_url, packed=False):
         # create the directory
         if os.path.isdir(self.location):
             print '%s: you are already in a mw repo' % self.me
@@ -71,8 +133,12 @@ class Metadir(object):
         else:
             os.mkdir(self.location, 0700)
         # metadir versioning
+        if packed:
+            self.version = packed_version
+        else:
+            self.version = version
         fd = file(os.path.join(self.location, 'version'), 'w')
-        fd.write(version)  # XXX THIS API VERSION NOT LOCKED IN YET
+        fd.write(self.version)  # XXX THIS API VERSION NOT LOCKED IN YET
         fd.close()
         # create config
         self.config = ConfigParser.RawConfigParser()
@@ -81,19 +147,59 @@ class Metadir(object):
         self.config.add_section('merge')
         self.config.set('merge', 'tool', 'kidff3 %s %s -o %s')
         self.save_config()
-        # create pages/
-        os.mkdir(os.path.join(self.location, 'pages'), 0755)
+        # create pages/ or pages.db
+        self.store = stores[self.version](self)
+        self.store.create()
 
-    def clean_page(self, filename):
+    def upgrade(self):
         """
-        Seems to remove the trailing newline from the page.
+        Moves the page records of a 'merkys/2' metadir into the packed
+        store of 'merkys/3'.  The version file is only switched once all
+        records are in, so an interrupted upgrade can simply be rerun.
         """
-        cur_content = codecs.open(filename, 'r', 'utf-8').read()
-        if len(cur_content) != 0 and cur_content[-1] == '\n':
-            cur_content = cur_content[:-1]
-        fd = file(filename, 'w')
-        fd.write(cur_content.encode('utf-8'))
+        if self.version == packed_version:
+            print '%s: mw repo is already packed' % self.me
+            return
+        old_store = self.store
+        new_store = stores[packed_version](self)
+        new_store.create()
+        new_store.begin()
+        for pagename in old_store.pagenames():
+            record = old_store.get_meta(pagename)
+            record['content'] = old_store.get_content(pagename)
+            new_store.put(pagename, record)
+        new_store.commit()
+        tmp_loc = self.version_loc + '.tmp'
+        fd = file(tmp_loc, 'w')
+        fd.write(packed_version)
         fd.close()
+        os.rename(tmp_loc, self.version_loc)
+        self.version = packed_version
+        self.store = new_store
+        self._pagedata = {}
+        for pagename in old_store.pagenames():
+            old_store.delete(pagename)
+        os.rmdir(old_store.location)
+
+    @contextlib.contextmanager
+    def batch(self):
+        """
+        Groups the page record writes done inside a with block into one
+        transaction, for stores that support it.  Whatever was written is
+        kept if the block fails, since the working files are already there.
+        """
+        self.store.begin()
+        try:
+            yield
+        finally:
+            self.store.commit()
+
+    def clean_page(self, filename):
+        """
+        Removes the trailing newline from the page, in place.
+        """
+        with open(filename, 'r+b') as fd:
+            fd.truncate(_working_size(fd))
 
     def get_pagefile_from_pagename(self, pagename):
         return os.path.join(self.location, 'pages',
@@ -110,12 +216,34 @@ class Metadir(object):
     def get_filename_from_pagename(self, pagename):
         return pagename_to_filename(pagename) + '.wiki'
 
+    def has_page(self, pagename):
+        if pagename in self._pagedata:
+            return True
+        return self.store.has(pagename)
+
+    def pagenames(self):
+        """
+        Lists the names of all tracked pages without reading their records.
+        """
+        return self.store.pagenames()
+
     def get_pagedata(self, pagename):
-        fd = file(self.get_pagefile_from_pagename(pagename),'r')
-        return json.loads(fd.read())
+        """
+        Returns the metadata of a page, without its content.  Each record
+        is read at most once; the content is left to the store, so walking
+        over many pages does not keep all of their texts in memory.
+        """
+        if pagename not in self._pagedata:
+            with mw.timing.phase('read metadata'):
+                self._pagedata[pagename] = self.store.get_meta(pagename)
+            mw.timing.count('records read')
+        return self._pagedata[pagename]
 
     def get_content(self, pagename):
-        return self.get_pagedata(pagename)['content']
+        return self.store.get_content(pagename)
+
+    def get_content_bytes(self, pagename):
+        return self.store.get_content_bytes(pagename)
 
     def get_author(self, pagename):
         return self.get_pagedata(pagename)['author']
@@ -126,85 +254,416 @@ class Metadir(object):
     def get_path(self, pagename):
         return self.get_pagedata(pagename)['path']
 
-    def set_content(self, pagename, content, author, revision, path):
-        pagefile = self.get_pagefile_from_pagename(pagename)
-        fd = file(pagefile, 'w')
-        fd.write(json.dumps({
+    def get_hash(self, pagename):
+        """
+        Returns the content hash of the base revision.  Records written
+        before the hash was stored get it added on first use.
+        """
+        data = self.get_pagedata(pagename)
+        if 'hash' not in data:
+            self.set_content(pagename, self.get_content(pagename),
+                             data['author'], data['revision'], data['path'])
+        return self.get_pagedata(pagename)['hash']
+
+    def set_content(self, pagename, content, author, revision, path,
+                    digest=None):
+        """
+        Records the base revision of a page.  digest is the content_hash of
+        content, if the caller already has it.
+        """
+        if digest is None:
+            digest = text_hash(content)
+        self.store.put(pagename, {
             'content' : content,
             'author'  : author,
             'revision': revision,
             'path'    : path,
-            }))
-        fd.truncate()
-        fd.close()
+            'hash'    : digest,
+            })
+        self._pagedata[pagename] = {
+            'author'  : author,
+            'revision': revision,
+            'path'    : path,
+            'hash'    : digest,
+            }
+
+    def remove_page(self, pagename):
+        self.store.delete(pagename)
+        self._pagedata.pop(pagename, None)
+
+    def prune_objects(self):
+        """
+        Drops stored base contents that no page refers to any more.
+        """
+        return self.store.prune_objects()
             
-    def working_dir_status(self, files=None):
-        status = {}
-        check = []
-        if files == None or files == []:
-            for root, dirs, files in os.walk(self.root):
-                if root == self.root:
-                    dirs.remove('.mw')
-                for name in files:
-                    name = name.decode('utf-8')
-                    if name.endswith('.wiki'):
-                        check.append(os.path.join(root, name))
-            for root, dirs, files in os.walk(os.path.join(self.location,
-                                                          'pages')):
-                for name in files:
-                    if name.endswith('.wiki'):
-                        pagename = self.get_pagename_from_filename(name)
-                        check.append(os.path.join(self.root,
-                                                  self.get_path(pagename)))
-        else:
-            for file in files:
-                check.append(os.path.join(os.getcwd(), file))
-        check = list(set(check))
-        for filename in check:
-            if filename.endswith('.wiki'):
-                status[filename] = self.get_status_filename(filename)
+    def working_dir_status(self, files=None, jobs=1):
+        """
+        Returns the status of the working files, all of them or those in
+        files.  A running mw watch is asked first.  Otherwise, with
+        jobs > 1, files that have to be read are hashed by a pool of that
+        many processes first.
+        """
+        with mw.timing.phase('status'):
+            full_scan = files == None or files == []
+            status = self._status_from_watcher(files, full_scan)
+            if status is not None:
+                return status
+            status = {}
+            check = []
+            if full_scan:
+                for root, dirs, files in os.walk(self.root):
+                    if root == self.root:
+                        dirs.remove('.mw')
+                    for name in files:
+                        name = name.decode('utf-8')
+                        if name.endswith('.wiki'):
+                            check.append(os.path.join(root, name))
+                with mw.timing.phase('read metadata'):
+                    for pagename, data in self.store.iter_meta():
+                        self._pagedata[pagename] = data
+                        check.append(os.path.join(self.root, data['path']))
+                        mw.timing.count('records read')
+            else:
+                for file in files:
+                    check.append(os.path.join(os.getcwd(), file))
+            check = list(set(check))
+            if jobs > 1:
+                self._hash_in_pool(check, jobs)
+            for filename in check:
+                if filename.endswith('.wiki'):
+                    status[filename] = self.get_status_filename(filename)
+            if full_scan:
+                self.prune_index(check)
+            self.save_index()
+            return status
+
+    def _status_from_watcher(self, files, full_scan):
+        """
+        Returns what mw watch knows of the status of files, or None if it
+        is not running.
+        """
+        if not self.use_watcher or \
+           not os.path.exists(os.path.join(self.location, 'watch.sock')):
+            return None
+        import mw.watch
+        if not full_scan:
+            files = [os.path.join(os.getcwd(), file) for file in files]
+        status = mw.watch.status(self, None if full_scan else files)
+        if status is not None:
+            mw.timing.count('status from watcher')
         return status
 
     def get_status_filename(self, filename):
         pagename = self.get_pagename_from_filename(filename)
-        if not os.path.exists(self.get_pagefile_from_filename(filename)):
+        if not self.has_page(pagename):
             return '?' # not added
         else:
+            mw.timing.count('files stat\'ed')
             if not os.path.exists(filename):
                 return '!' # file is deleted
             if os.path.relpath(filename,self.root) != self.get_path(pagename):
                 return '?' # added, but not this page
         if self.get_revision(pagename) is None:
             return 'A' # just added
-        if self.diff_rv_to_working(filename) != '':
+        if self.is_modified(filename):
             return 'M' # modified
         else:
             return None
 
+    def get_index(self):
+        """
+        Returns the stat cache of tracked working files, loading it from
+        .mw/index on first use.  Each entry is keyed by the path relative
+        to the repo root and records the mtime, size and inode the file had
+        when it was last hashed, the hash itself and when it was taken.
+        """
+        if self._index is None:
+            self._index = {'entries': {}}
+            if os.path.isfile(self.index_loc):
+                try:
+                    with open(self.index_loc, 'r') as fd:
+                        self._index = json.loads(fd.read())
+                except ValueError:
+                    pass # corrupt index, it is only a cache
+            self._index_dirty = False
+        return self._index
+
+    def save_index(self):
+        if self._index is None or not self._index_dirty:
+            return
+        tmp_loc = self.index_loc + '.tmp'
+        with open(tmp_loc, 'w') as fd:
+            fd.write(json.dumps(self._index))
+        os.rename(tmp_loc, self.index_loc)
+        self._index_dirty = False
+
+    def prune_index(self, filenames):
+        """
+        Drops index entries of files that are not in filenames.
+        """
+        keep = set([os.path.relpath(f, self.root) for f in filenames])
+        entries = self.get_index()['entries']
+        for relpath in entries.keys():
+            if relpath not in keep:
+                del entries[relpath]
+                self._index_dirty = True
+
+    def hash_working(self, filename):
+        """
+        Hashes the working file the same way diff_rv_to_working sees it,
+        i.e. without its trailing newline.
+        """
+        mw.timing.count('files read')
+        return hash_file(filename)
+
+    def _hash_in_pool(self, filenames, jobs):
+        """
+        Hashes those of filenames that are tracked and not up to date in
+        the index, using jobs processes.  The results are kept aside for
+        get_working_hash.
+        """
+        todo = []
+        for filename in filenames:
+            if not filename.endswith('.wiki') or \
+               not self.has_page(self.get_pagename_from_filename(filename)):
+                continue
+            try:
+                st = os.stat(filename)
+            except OSError:
+                continue
+            mw.timing.count('files stat\'ed')
+            if self._indexed_hash(filename, st) is None:
+                todo.append(filename)
+        # starting processes costs more than hashing a few files
+        if len(todo) < jobs * self.pool_min_files:
+            return
+        import multiprocessing
+        with mw.timing.phase('status: hash in pool'):
+            pool = multiprocessing.Pool(jobs)
+            try:
+                for filename, st, digest, hashed in pool.imap_unordered(
+                        _stat_and_hash, todo, self.pool_chunk_size):
+                    self._hashed[filename] = (st, digest, hashed)
+            finally:
+                pool.close()
+                pool.join()
+        mw.timing.count('files read', len(todo))
+
+    def diffs(self, filenames, jobs=1):
+        """
+        Yields the diffs of the given working files in order, generated by
+        jobs processes at once.
+        """
+        if jobs <= 1 or len(filenames) < 2:
+            for filename in filenames:
+                yield self.diff_rv_to_working(filename)
+            return
+        import multiprocessing
+        pool = multiprocessing.Pool(min(jobs, len(filenames)),
+                                    _start_diff_worker)
+        try:
+            for diff in pool.imap(_diff_in_worker, filenames):
+                mw.timing.count('pages diffed')
+                yield diff
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def is_modified(self, filename):
+        """
+        Tells whether a tracked working file differs from its base revision
+        by comparing content hashes.  Files whose stat data matches the
+        index are not read at all.
+        """
+        pagename = self.get_pagename_from_filename(filename)
+        return self.get_working_hash(filename) != self.get_hash(pagename)
+
+    def get_working_hash(self, filename):
+        relpath = os.path.relpath(filename, self.root)
+        if filename in self._hashed:
+            st, digest, hashed = self._hashed.pop(filename)
+            self._set_index_entry(relpath, st, digest, hashed)
+            return digest
+        hashed = time.time()
+        st = os.stat(filename)
+        mw.timing.count('files stat\'ed')
+        digest = self._indexed_hash(filename, st)
+        if digest is not None:
+            return digest
+        digest = self.hash_working(filename)
+        self._set_index_entry(relpath, st, digest, hashed)
+        return digest
+
+    def _indexed_hash(self, filename, st):
+        """
+        Returns the hash the index has for a working file with the given
+        stat data, or None if there is no entry that can be trusted.
+        """
+        index = self.get_index()
+        entry = index['entries'].get(os.path.relpath(filename, self.root))
+        # an entry is only trusted if the file was hashed after its mtime
+        # second was over, otherwise an edit in the same second, of the
+        # same size, could hide
+        if entry is not None and \
+           entry['mtime'] == st.st_mtime and \
+           entry['size'] == st.st_size and \
+           entry['ino'] == st.st_ino and \
+           st.st_mtime + 1 < entry.get('hashed', 0):
+            return entry['hash']
+        return None
+
+    def refresh_index(self, filename, digest=None):
+        """
+        Records the stat data and hash of a working file that was just
+        written.  digest saves reading the file back if the caller knows
+        its hash already.
+        """
+        self.get_index()
+        hashed = time.time()
+        if digest is None:
+            digest = self.hash_working(filename)
+        self._set_index_entry(os.path.relpath(filename, self.root),
+                              os.stat(filename), digest, hashed)
+
+    def _set_index_entry(self, relpath, st, digest, hashed):
+        self._index['entries'][relpath] = {
+            'mtime'   : st.st_mtime,
+            'size'    : st.st_size,
+            'ino'     : st.st_ino,
+            'hash'    : digest,
+            'hashed'  : hashed,
+            }
+        self._index_dirty = True
+
     def diff_rv_to_working(self, filename):
+        with mw.timing.phase('diff'):
+            return self._diff_rv_to_working(filename)
+
+    def _diff_rv_to_working(self, filename):
+        mw.timing.count('pages diffed')
+        mw.timing.count('files read')
         pagename = self.get_pagename_from_filename(filename)
-        old_content = self.get_content(pagename)
+        old = self.get_content_bytes(pagename)
         oldrev = self.get_revision(pagename)
-        oldname = ''
         if oldrev is not None:
             oldname = 'a/%s (revision %i)' % (pagename, oldrev)
         else:
             oldname = 'a/%s (uncommitted)' % (pagename)
-        old = [i + '\n' for i in \
-                   old_content.encode('utf-8').split('\n')]
-        cur_content = codecs.open(filename, 'r', 'utf-8').read()
-        cur_content = cur_content.encode('utf-8')
-        if (len(cur_content) != 0) and (cur_content[-1] == '\n'):
-            cur_content = cur_content[:-1]
+        new = read_working(filename)
         newname = 'b/%s (working copy)' % pagename
-        new = [i + '\n' for i in cur_content.split('\n')]
-        diff_fd = StringIO()
-        bzrlib.diff.internal_diff(oldname, old, newname, new, diff_fd)
-        diff = diff_fd.getvalue()
-        if diff and diff[-1] == '\n':
-            diff = diff[:-1]
-        return diff
+        return ''.join(mw.diff.unified_diff(old, new,
+                                            oldname.encode('utf-8'),
+                                            newname.encode('utf-8')))
+
+
+def _working_size(fd):
+    """
+    Returns the size of the open working file fd without its trailing
+    newline, leaving fd at its start.
+    """
+    size = os.fstat(fd.fileno()).st_size
+    if size != 0:
+        fd.seek(size - 1)
+        if fd.read(1) == '\n':
+            size -= 1
+        fd.seek(0)
+    return size
+
+
+def read_working(filename):
+    """
+    Returns the content of a working file as bytes, without its trailing
+    newline.  The newline is never read, so the content is not copied to
+    drop it.
+    """
+    with open(filename, 'rb') as fd:
+        return fd.read(_working_size(fd))
+
+
+def hash_file(filename):
+    """
+    Hashes a working file without its trailing newline, see content_hash.
+    The file is read a chunk at a time.
+    """
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as fd:
+        left = _working_size(fd)
+        while left > 0:
+            chunk = fd.read(min(left, chunk_size))
+            if not chunk:
+                break
+            digest.update(chunk)
+            left -= len(chunk)
+    return digest.hexdigest()
+
+
+def _encode(content):
+    """
+    Yields unicode content encoded as UTF-8 a chunk at a time.
+    """
+    start = 0
+    while start < len(content):
+        end = start + chunk_size
+        # a surrogate pair of a narrow build must not be split
+        if end < len(content) and u'\ud800' <= content[end - 1] <= u'\udbff':
+            end += 1
+        yield content[start:end].encode('utf-8')
+        start = end
+
+
+def text_hash(content):
+    """
+    Returns the content_hash of unicode content without encoding all of it
+    at once.
+    """
+    digest = hashlib.sha1()
+    for chunk in _encode(content):
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+def write_page(filename, content):
+    """
+    Writes unicode page content to a working file as UTF-8 and returns its
+    content_hash, encoding it a chunk at a time.
+    """
+    digest = hashlib.sha1()
+    with open(filename, 'wb') as fd:
+        for chunk in _encode(content):
+            digest.update(chunk)
+            fd.write(chunk)
+    return digest.hexdigest()
+
+
+# what the processes of a pool run; they have to be plain functions
+
+def _stat_and_hash(filename):
+    hashed = time.time()
+    st = os.stat(filename)
+    return filename, st, hash_file(filename), hashed
+
+
+_worker_metadir = None
+
+def _start_diff_worker():
+    global _worker_metadir
+    # a metadir of its own, the parent's database connection must not be
+    # used from another process
+    _worker_metadir = Metadir()
+
+
+def _diff_in_worker(filename):
+    return _worker_metadir.diff_rv_to_working(filename)
+
 
+def content_hash(content):
+    """
+    Hashes page content given as UTF-8 bytes.  Base revisions are hashed as
+    stored and working files after dropping their trailing newline, so two
+    hashes are equal exactly when diff_rv_to_working finds no difference.
+    """
+    return hashlib.sha1(content).hexdigest()
 
 def pagename_to_filename(name):
     name = name.replace(' ', '_')
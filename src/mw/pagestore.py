@@ -0,0 +1,285 @@
+###
+# mw - VCS-like nonsense for MediaWiki websites
+# Copyright (C) 2011  Ian Weller <ian@ianweller.org> and others
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+###
+
+"""
+Storage backends for the page records of a metadir.
+
+A record holds the base revision of a tracked page: its content, author,
+revision, path of the working file and content hash.  Stores hand out the
+metadata and the content separately, so callers that only need to know the
+revision or path of a page do not have to keep its text around.
+"""
+
+import hashlib
+import json
+import os
+import sys
+import zlib
+
+
+def _unicode(name):
+    if isinstance(name, str):
+        return name.decode('utf-8')
+    return name
+
+
+class FilePageStore(object):
+    """
+    One JSON file per page under .mw/pages, used by 'merkys/2' metadirs.
+    """
+
+    def __init__(self, metadir):
+        self.metadir = metadir
+        self.location = os.path.join(metadir.location, 'pages')
+        self._content = None
+
+    def create(self):
+        os.mkdir(self.location, 0755)
+
+    def has(self, pagename):
+        pagefile = self.metadir.get_pagefile_from_pagename(pagename)
+        return os.path.exists(pagefile)
+
+    def pagenames(self):
+        names = []
+        for root, dirs, files in os.walk(self.location):
+            for name in files:
+                if name.endswith('.wiki'):
+                    names.append(self.metadir.get_pagename_from_filename(
+                        name.decode('utf-8')))
+        return names
+
+    def iter_meta(self):
+        for pagename in self.pagenames():
+            yield pagename, self.get_meta(pagename)
+
+    def get_meta(self, pagename):
+        """
+        Returns the record of a page without its content.  The content of
+        the most recently read page is kept aside for get_content, as the
+        whole file has to be parsed anyway.
+        """
+        fd = file(self.metadir.get_pagefile_from_pagename(pagename), 'r')
+        data = json.loads(fd.read())
+        fd.close()
+        self._content = (pagename, data.pop('content'))
+        return data
+
+    def get_content(self, pagename):
+        if self._content is None or self._content[0] != pagename:
+            self.get_meta(pagename)
+        return self._content[1]
+
+    def get_content_bytes(self, pagename):
+        return self.get_content(pagename).encode('utf-8')
+
+    def put(self, pagename, record):
+        fd = file(self.metadir.get_pagefile_from_pagename(pagename), 'w')
+        fd.write(json.dumps(record))
+        fd.truncate()
+        fd.close()
+        self._content = (pagename, record['content'])
+
+    def delete(self, pagename):
+        os.unlink(self.metadir.get_pagefile_from_pagename(pagename))
+        if self._content is not None and self._content[0] == pagename:
+            self._content = None
+
+    def prune_objects(self):
+        return 0
+
+    def begin(self):
+        pass
+
+    def commit(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class ObjectStore(object):
+    """
+    Content-addressed, zlib-compressed blobs under .mw/objects, named by
+    the SHA-1 of their content like git's loose objects.  Identical texts
+    are stored once.
+    """
+
+    def __init__(self, location):
+        self.location = location
+
+    def _path(self, digest):
+        return os.path.join(self.location, digest[:2], digest[2:])
+
+    def put(self, data):
+        """
+        Stores data, given as bytes, and returns its hash.
+        """
+        digest = hashlib.sha1(data).hexdigest()
+        path = self._path(digest)
+        if not os.path.exists(path):
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            tmp_path = path + '.tmp'
+            with open(tmp_path, 'wb') as fd:
+                fd.write(zlib.compress(data))
+            os.rename(tmp_path, path)
+        return digest
+
+    def get(self, digest):
+        with open(self._path(digest), 'rb') as fd:
+            return zlib.decompress(fd.read())
+
+    def prune(self, keep):
+        """
+        Deletes all blobs whose hash is not in keep, returns their count.
+        """
+        pruned = 0
+        if not os.path.isdir(self.location):
+            return pruned
+        for fanout in os.listdir(self.location):
+            for name in os.listdir(os.path.join(self.location, fanout)):
+                if fanout + name not in keep:
+                    os.unlink(os.path.join(self.location, fanout, name))
+                    pruned += 1
+        return pruned
+
+
+class PackedPageStore(object):
+    """
+    All records in one SQLite database, .mw/pages.db, used by 'merkys/3'
+    metadirs.  Writes between begin() and commit() go into one transaction;
+    outside of it every write is committed on its own.  Contents live in
+    the object store, the database only refers to them by hash.  The schema
+    version is kept in the database's user_version, and databases written
+    by a newer mw are refused.
+    """
+
+    schema = 1
+
+    def __init__(self, metadir):
+        self.metadir = metadir
+        self.location = os.path.join(metadir.location, 'pages.db')
+        self.objects = ObjectStore(os.path.join(metadir.location, 'objects'))
+        self._db = None
+        self._depth = 0
+
+    @property
+    def db(self):
+        if self._db is None:
+            import sqlite3
+            self._db = sqlite3.connect(self.location, isolation_level=None)
+            self._check_schema()
+        return self._db
+
+    def _check_schema(self):
+        version = self._db.execute('PRAGMA user_version').fetchone()[0]
+        if version > self.schema:
+            print '%s: mw repo is incompatible' % self.metadir.me
+            sys.exit(1)
+
+    def create(self):
+        if os.path.exists(self.location):
+            os.unlink(self.location)
+        self.db.executescript("""
+            CREATE TABLE pages (
+                pagename TEXT PRIMARY KEY,
+                path     TEXT NOT NULL,
+                author   TEXT,
+                revision INTEGER,
+                hash     TEXT NOT NULL
+            );
+            CREATE INDEX pages_path ON pages (path);
+            PRAGMA user_version = %d;
+            """ % self.schema)
+
+    def has(self, pagename):
+        cursor = self.db.execute('SELECT 1 FROM pages WHERE pagename = ?',
+                                 (_unicode(pagename),))
+        return cursor.fetchone() is not None
+
+    def pagenames(self):
+        cursor = self.db.execute('SELECT pagename FROM pages')
+        return [row[0] for row in cursor]
+
+    def iter_meta(self):
+        cursor = self.db.execute('SELECT pagename, author, revision, path, '
+                                 'hash FROM pages')
+        for row in cursor:
+            yield row[0], self._meta(row[1:])
+
+    def get_meta(self, pagename):
+        cursor = self.db.execute('SELECT author, revision, path, hash '
+                                 'FROM pages WHERE pagename = ?',
+                                 (_unicode(pagename),))
+        row = cursor.fetchone()
+        if row is None:
+            raise KeyError(pagename)
+        return self._meta(row)
+
+    def _meta(self, row):
+        return {'author': row[0], 'revision': row[1], 'path': row[2],
+                'hash': row[3]}
+
+    def get_content(self, pagename):
+        return self.get_content_bytes(pagename).decode('utf-8')
+
+    def get_content_bytes(self, pagename):
+        """
+        Returns the content as UTF-8, the way it is stored.
+        """
+        cursor = self.db.execute('SELECT hash FROM pages WHERE pagename = ?',
+                                 (_unicode(pagename),))
+        row = cursor.fetchone()
+        if row is None:
+            raise KeyError(pagename)
+        return self.objects.get(row[0])
+
+    def put(self, pagename, record):
+        digest = self.objects.put(record['content'].encode('utf-8'))
+        self.db.execute('INSERT OR REPLACE INTO pages '
+                        '(pagename, path, author, revision, hash) '
+                        'VALUES (?, ?, ?, ?, ?)',
+                        (_unicode(pagename), _unicode(record['path']),
+                         record['author'], record['revision'], digest))
+
+    def prune_objects(self):
+        """
+        Deletes the blobs no record refers to any more.
+        """
+        cursor = self.db.execute('SELECT DISTINCT hash FROM pages')
+        return self.objects.prune(set([row[0] for row in cursor]))
+
+    def delete(self, pagename):
+        self.db.execute('DELETE FROM pages WHERE pagename = ?',
+                        (_unicode(pagename),))
+
+    def begin(self):
+        if self._depth == 0:
+            self.db.execute('BEGIN')
+        self._depth += 1
+
+    def commit(self):
+        self._depth -= 1
+        if self._depth == 0:
+            self.db.execute('COMMIT')
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
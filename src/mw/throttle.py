@@ -0,0 +1,121 @@
+###
+# mw - VCS-like nonsense for MediaWiki websites
+# Copyright (C) 2011  Ian Weller <ian@ianweller.org> and others
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+###
+
+import mw.timing
+import time
+
+
+class Scheduler(object):
+    """
+    Paces writes to the wiki with a token bucket: up to burst edits may go
+    out at once, after that one per 60 / rate seconds.  When the wiki says
+    it is lagged or rate limits us, backoff() waits exponentially longer,
+    or as long as the wiki asked for if that is longer still.
+
+    The settings are read from the [commit] section of .mw/config:
+
+        rate = 6          edits per minute, 0 for no limit
+        burst = 1         edits that may be sent without waiting
+        maxlag = 5        seconds of replication lag at which the wiki
+                          should refuse our edits, 0 to not send maxlag
+        max_backoff = 300 longest single wait after an error, in seconds
+        max_retries = 8   errors in a row before an edit is given up
+    """
+
+    defaults = {
+        'rate': 6.0,
+        'burst': 1.0,
+        'maxlag': 5,
+        'max_backoff': 300.0,
+        'max_retries': 8,
+    }
+
+    def __init__(self, rate=6.0, burst=1.0, maxlag=5, max_backoff=300.0,
+                 max_retries=8):
+        self.rate = rate
+        self.burst = max(1.0, burst)
+        self.maxlag = maxlag
+        self.max_backoff = max_backoff
+        self.max_retries = max_retries
+        self.tokens = self.burst
+        self.last = time.time()
+        self.failures = 0
+        self.throttled = 0.0
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Makes a scheduler with the settings of config.  A setting that is
+        not a number raises ValueError naming it.
+        """
+        settings = {}
+        for name, default in cls.defaults.items():
+            if config.has_option('commit', name):
+                value = config.get('commit', name)
+                try:
+                    settings[name] = type(default)(value)
+                except ValueError:
+                    raise ValueError('invalid %s in [commit] section: %r' %
+                                     (name, value))
+            else:
+                settings[name] = default
+        return cls(**settings)
+
+    def _sleep(self, delay):
+        time.sleep(delay)
+        self.throttled += delay
+        mw.timing.add_time('commit: throttle', delay)
+        return delay
+
+    def wait(self):
+        """
+        Takes a token from the bucket, waiting for one if it is empty.
+        Returns how long it waited.
+        """
+        now = time.time()
+        if self.rate > 0:
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.last) * self.rate / 60)
+        else:
+            self.tokens = self.burst
+        self.last = now
+        delay = 0.0
+        if self.tokens < 1:
+            delay = self._sleep((1 - self.tokens) * 60 / self.rate)
+            self.tokens = 1
+            self.last = time.time()
+        self.tokens -= 1
+        return delay
+
+    def backoff(self, retry_after=None):
+        """
+        Waits after the wiki refused a request for being lagged or rate
+        limited.  Returns how long it waited, or None if the request has
+        failed too often in a row and should be given up.
+        """
+        self.failures += 1
+        if self.failures > self.max_retries:
+            self.failures = 0
+            return None
+        delay = min(self.max_backoff, 2 ** (self.failures - 1))
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return self._sleep(delay)
+
+    def success(self):
+        self.failures = 0
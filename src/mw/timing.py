@@ -0,0 +1,147 @@
+###
+# mw - VCS-like nonsense for MediaWiki websites
+# Copyright (C) 2011  Ian Weller <ian@ianweller.org> and others
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+###
+
+"""
+Counters that tell where a mw run spends its time.
+
+The module keeps one set of counters per process.  Code that does
+something worth knowing about calls count() or wraps it in phase(); the
+transport reports every API call with api_call().  mw --timings prints the
+counters when the command is done, and as_dict() hands them out to
+anything else that wants them.
+"""
+
+import contextlib
+import sys
+import threading
+import time
+
+# upper bounds of the buckets of the API latency histogram, in seconds
+buckets = [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+
+_lock = threading.Lock()
+
+
+def reset():
+    """
+    Sets all counters back to zero.
+    """
+    global _start, _phases, _order, _counters, _histogram, _api
+    with _lock:
+        _start = time.time()
+        _phases = {}
+        _order = []
+        _counters = {}
+        _histogram = [0] * (len(buckets) + 1)
+        _api = {'calls': 0, 'seconds': 0.0, 'bytes_sent': 0,
+                'bytes_received': 0}
+
+reset()
+
+
+def count(name, n=1):
+    """
+    Adds n to the counter called name.
+    """
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + n
+
+
+def add_time(name, seconds):
+    """
+    Adds seconds to the wall time spent in phase name.
+    """
+    with _lock:
+        if name not in _phases:
+            _phases[name] = 0.0
+            _order.append(name)
+        _phases[name] += seconds
+
+
+@contextlib.contextmanager
+def phase(name):
+    """
+    Adds the time spent in the with block to phase name.  Phases may nest,
+    the time of an inner phase is part of the outer one too.
+    """
+    start = time.time()
+    try:
+        yield
+    finally:
+        add_time(name, time.time() - start)
+
+
+def api_call(seconds, bytes_sent, bytes_received):
+    """
+    Records an API call that took seconds from sending the request to
+    reading the end of the response.
+    """
+    bucket = 0
+    while bucket < len(buckets) and seconds > buckets[bucket]:
+        bucket += 1
+    with _lock:
+        _api['calls'] += 1
+        _api['seconds'] += seconds
+        _api['bytes_sent'] += bytes_sent
+        _api['bytes_received'] += bytes_received
+        _histogram[bucket] += 1
+
+
+def as_dict():
+    """
+    Returns a snapshot of all counters.
+    """
+    with _lock:
+        return {
+            'total': time.time() - _start,
+            'phases': [[name, _phases[name]] for name in _order],
+            'counters': dict(_counters),
+            'api': dict(_api),
+            'api_latency': [[bound, n] for bound, n in
+                            zip(buckets + [None], _histogram)],
+        }
+
+
+def report(out=sys.stderr):
+    """
+    Prints the counters in a human readable way.
+    """
+    data = as_dict()
+    print >> out, 'timings:'
+    print >> out, '  %-26s %9.3fs' % ('total', data['total'])
+    for name, seconds in data['phases']:
+        print >> out, '  %-26s %9.3fs' % (name, seconds)
+    api = data['api']
+    print >> out, '  %-26s %9d  (%.3fs waiting)' % ('api calls',
+                                                   api['calls'],
+                                                   api['seconds'])
+    print >> out, '  %-26s %9d' % ('bytes sent', api['bytes_sent'])
+    print >> out, '  %-26s %9d' % ('bytes received', api['bytes_received'])
+    for name in sorted(data['counters']):
+        print >> out, '  %-26s %9d' % (name, data['counters'][name])
+    if api['calls']:
+        print >> out, '  api latency:'
+        lower = 0
+        for bound, n in data['api_latency']:
+            if bound is None:
+                label = '> %gs' % lower
+            else:
+                label = '%g - %gs' % (lower, bound)
+                lower = bound
+            if n:
+                print >> out, '    %-24s %9d' % (label, n)
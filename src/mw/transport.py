@@ -0,0 +1,353 @@
+###
+# mw - VCS-like nonsense for MediaWiki websites
+# Copyright (C) 2011  Ian Weller <ian@ianweller.org> and others
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+###
+
+"""
+HTTP transport for the MediaWiki API.
+
+Requests go out over persistent connections, one per thread, so a pull or
+commit of thousands of pages sets up TCP and TLS once per thread instead of
+once per request.  Responses are asked for gzip-compressed and inflated as
+they are read.  Cookies are kept in a Mozilla cookie file, the same format
+earlier versions of mw wrote to .mw/cookies.
+"""
+
+import cookielib
+import httplib
+import json
+import mw.timing
+import socket
+import threading
+import time
+import urllib
+import urllib2
+import urlparse
+import zlib
+
+user_agent = 'mw/0.1 +https://github.com/ianweller/mw'
+
+
+class _Response(object):
+    """
+    What cookielib needs to see of a response to pick up its cookies.
+    """
+
+    def __init__(self, response):
+        self.response = response
+
+    def info(self):
+        return self.response.msg
+
+
+class Api(object):
+    """
+    Sends API calls to the wiki at api_url.  call() takes a dict of query
+    parameters and returns the decoded JSON response; HTTP errors are
+    raised as urllib2.HTTPError, with the response headers available from
+    its info().  The headers of the last response to a thread's call are
+    kept for last_headers(), as errors like maxlag come with status 200 and
+    a Retry-After header.  An Api may be shared by several threads.
+    """
+
+    # how many bytes of a response are read and inflated at a time
+    chunk_size = 64 * 1024
+    # how often call() sends a read again after a transient failure
+    retries = 4
+
+    def __init__(self, api_url, cookie_file=None, timeout=120):
+        self.api_url = api_url
+        self.timeout = timeout
+        url = urlparse.urlsplit(api_url)
+        self.scheme = url.scheme
+        self.host = url.netloc
+        self.path = url.path or '/'
+        if url.query:
+            self.path += '?' + url.query
+        self.proxy = None
+        if not urllib.proxy_bypass(url.hostname or ''):
+            proxy = urllib.getproxies().get(self.scheme)
+            if proxy:
+                self.proxy = urlparse.urlsplit(proxy).netloc
+        if cookie_file is not None:
+            self.cookies = cookielib.MozillaCookieJar(cookie_file)
+            try:
+                self.cookies.load()
+            except IOError:
+                self.cookies.save()
+        else:
+            self.cookies = cookielib.CookieJar()
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        # connections given back by bodies read in another thread
+        self.idle = []
+
+    def _connect(self):
+        if self.scheme == 'https':
+            connection_class = httplib.HTTPSConnection
+        else:
+            connection_class = httplib.HTTPConnection
+        if self.proxy is None:
+            connection = connection_class(self.host, timeout=self.timeout)
+        elif self.scheme == 'https':
+            connection = connection_class(self.proxy, timeout=self.timeout)
+            connection.set_tunnel(self.host)
+        else:
+            connection = connection_class(self.proxy, timeout=self.timeout)
+        mw.timing.count('http connections')
+        return connection
+
+    def _connection(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            with self.lock:
+                if self.idle:
+                    connection = self.idle.pop()
+            if connection is None:
+                connection = self._connect()
+            self.local.connection = connection
+        return connection
+
+    def _release(self, connection):
+        with self.lock:
+            self.idle.append(connection)
+
+    def close(self):
+        """
+        Closes the connection of the calling thread.
+        """
+        connection = getattr(self.local, 'connection', None)
+        if connection is not None:
+            connection.close()
+            self.local.connection = None
+
+    def call(self, params, retries=None):
+        """
+        Sends an API call and returns the decoded response.  Calls that
+        fail with a server error, 429 or a network error are sent again up
+        to retries times (default: self.retries), after the Retry-After
+        the wiki asked for or a growing delay.  Calls carrying a token are
+        writes that may have taken effect and are never sent again.
+        """
+        if retries is None:
+            retries = self.retries
+        if 'token' in params:
+            retries = 0
+        attempt = 0
+        while True:
+            try:
+                body = self._open(params)
+                try:
+                    data = body.read()
+                finally:
+                    body.close()
+                return json.loads(data)
+            except (socket.error, httplib.HTTPException,
+                    urllib2.URLError), e:
+                if attempt >= retries or not _transient(e):
+                    raise
+            delay = 2 ** attempt
+            headers = self.last_headers()
+            if isinstance(e, urllib2.HTTPError) and headers is not None:
+                retry_after = headers.getheader('Retry-After')
+                if retry_after is not None and retry_after.isdigit():
+                    delay = max(1, int(retry_after))
+            mw.timing.count('api retries')
+            attempt += 1
+            time.sleep(delay)
+
+    def open(self, params):
+        """
+        Sends an API call like call(), but returns the response body as a
+        file-like object to be read as it arrives, for answers that are not
+        JSON like those of export with exportnowrap.  The body keeps the
+        connection it came over until it is closed, so it may be read in
+        another thread, and the calling thread may send other calls
+        meanwhile.
+        """
+        return self._open(params, detach=True)
+
+    def _open(self, params, detach=False):
+        request, response, start, sent = self._post(params)
+        self.local.headers = response.msg
+        connection = None
+        if detach:
+            connection = self.local.connection
+            self.local.connection = None
+        body = _Body(self, response, start, sent, connection)
+        try:
+            self._check(request, response)
+        except:
+            body.close()
+            raise
+        return body
+
+    def last_headers(self):
+        """
+        Returns the headers of the last response the calling thread got,
+        as a mimetools.Message, or None.
+        """
+        return getattr(self.local, 'headers', None)
+
+    def _post(self, params):
+        params = dict(params)
+        params['format'] = 'json'
+        body = urllib.urlencode([(_bytes(key), _bytes(value))
+                                 for key, value in params.items()])
+        url = self.api_url
+        if self.proxy is not None and self.scheme == 'http':
+            path = url
+        else:
+            path = self.path
+        # cookielib works on urllib2 requests
+        request = urllib2.Request(url, body)
+        self.cookies.add_cookie_header(request)
+        headers = {
+            'User-Agent': user_agent,
+            'Accept-Encoding': 'gzip',
+            'Content-Type': 'application/x-www-form-urlencoded',
+        }
+        if request.has_header('Cookie'):
+            headers['Cookie'] = request.get_header('Cookie')
+        start = time.time()
+        return request, self._send(path, body, headers), start, len(body)
+
+    def _check(self, request, response):
+        """
+        Picks up the cookies of a response and raises HTTP errors.
+        """
+        if response.getheader('Set-Cookie') is not None:
+            self.cookies.extract_cookies(_Response(response), request)
+            if isinstance(self.cookies, cookielib.MozillaCookieJar):
+                with self.lock:
+                    self.cookies.save()
+        if response.status >= 400:
+            raise urllib2.HTTPError(self.api_url, response.status,
+                                    response.reason, response.msg, None)
+
+    def _send(self, path, body, headers):
+        """
+        Sends a POST request over the connection of the calling thread and
+        returns the response.  A connection the server closed while it was
+        idle is opened again once.
+        """
+        connection = self._connection()
+        reused = connection.sock is not None
+        try:
+            connection.request('POST', path, body, headers)
+            return connection.getresponse()
+        except (httplib.BadStatusLine, httplib.CannotSendRequest,
+                socket.error), e:
+            self.close()
+            if not reused or isinstance(e, socket.timeout):
+                raise
+        connection = self._connection()
+        try:
+            connection.request('POST', path, body, headers)
+            return connection.getresponse()
+        except:
+            self.close()
+            raise
+
+
+class _Body(object):
+    """
+    The body of a response, inflated as it is read.  If it was given the
+    connection, it hands it back to the api once it is read, instead of
+    leaving it to the thread that sent the request.
+    """
+
+    def __init__(self, api, response, start, sent, connection=None):
+        self.api = api
+        self.response = response
+        self.connection = connection
+        self.start = start
+        self.sent = sent
+        self.received = 0
+        self.inflate = None
+        if response.getheader('Content-Encoding') == 'gzip':
+            # 16 + MAX_WBITS makes zlib expect a gzip header
+            self.inflate = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.buffer = ''
+        self.offset = 0
+        self.done = False
+        self.closed = False
+
+    def info(self):
+        return self.response.msg
+
+    def _fill(self):
+        try:
+            chunk = self.response.read(self.api.chunk_size)
+        except:
+            self.close()
+            raise
+        if not chunk:
+            self.done = True
+            self.buffer = self.inflate and self.inflate.flush() or ''
+        else:
+            self.received += len(chunk)
+            if self.inflate is not None:
+                chunk = self.inflate.decompress(chunk)
+            self.buffer = chunk
+        self.offset = 0
+
+    def read(self, size=-1):
+        if size < 0:
+            chunks = [self.buffer[self.offset:]]
+            self.buffer = ''
+            while not self.done:
+                self._fill()
+                chunks.append(self.buffer)
+            self.buffer = ''
+            return ''.join(chunks)
+        while self.offset >= len(self.buffer) and not self.done:
+            self._fill()
+        data = self.buffer[self.offset:self.offset + size]
+        self.offset += len(data)
+        return data
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        mw.timing.api_call(time.time() - self.start, self.sent,
+                           self.received)
+        # an unread rest would end up in the next response
+        reusable = self.done and not self.response.will_close
+        if self.connection is None:
+            if not reusable:
+                self.api.close()
+        elif reusable:
+            self.api._release(self.connection)
+        else:
+            self.connection.close()
+
+
+def _transient(error):
+    """
+    Whether an exception call() got is worth sending the call again for.
+    """
+    if isinstance(error, urllib2.HTTPError):
+        return error.code == 429 or error.code >= 500
+    # URLErrors other than HTTPError come from urllib2 itself
+    return not isinstance(error, urllib2.URLError)
+
+
+def _bytes(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
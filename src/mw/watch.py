@@ -0,0 +1,464 @@
+###
+# mw - VCS-like nonsense for MediaWiki websites
+# Copyright (C) 2011  Ian Weller <ian@ianweller.org> and others
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+###
+
+"""
+A daemon that keeps the status of a working directory up to date.
+
+mw watch scans the working directory once and then follows changes to the
+working files and the page records with Linux's inotify, so it knows which
+files it has to look at again.  Metadir.working_dir_status asks it for the
+status over the Unix socket .mw/watch.sock and scans on its own if there is
+no answer.
+
+Requests and answers are single lines of JSON:
+
+    {"files": null}              the status of the whole working directory
+    {"files": ["/abs/a.wiki"]}   the status of some files
+    {"stop": true}               makes the daemon exit
+
+and the answer is {"status": {filename: status}} or {"stopping": true}.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import json
+import os
+import select
+import signal
+import socket
+import struct
+import sys
+import traceback
+
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0x80000
+
+# what to hear about in a watched directory
+watch_mask = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | \
+    IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+
+# how long a client waits for the daemon before scanning itself
+timeout = 10.0
+
+_event = struct.Struct('iIII')
+
+
+class Inotify(object):
+    """
+    The inotify calls of the C library, through ctypes.
+    """
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                           use_errno=True)
+        try:
+            self._add_watch = libc.inotify_add_watch
+            init = libc.inotify_init1
+        except AttributeError:
+            raise OSError(errno.ENOSYS, 'inotify is not available')
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p,
+                                    ctypes.c_uint32]
+        self.fd = init(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+
+    def add_watch(self, path, mask):
+        if isinstance(path, unicode):
+            path = path.encode('utf-8')
+        wd = self._add_watch(self.fd, path, mask)
+        if wd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error), path)
+        return wd
+
+    def read(self):
+        """
+        Returns the pending events as (wd, mask, name) tuples, nothing if
+        there are none.
+        """
+        events = []
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except OSError, e:
+                if e.errno == errno.EAGAIN:
+                    return events
+                raise
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = _event.unpack_from(data, offset)
+                offset += _event.size
+                name = data[offset:offset + length].rstrip('\0')
+                offset += length
+                events.append((wd, mask, name.decode('utf-8', 'replace')))
+
+    def close(self):
+        os.close(self.fd)
+
+
+class Watcher(object):
+    """
+    Keeps the status of the working files of a metadir.  Files that events
+    were seen for are only looked at again when a client asks.
+    """
+
+    def __init__(self, metadir):
+        self.metadir = metadir
+        # the daemon is the one place that must not ask itself
+        metadir.use_watcher = False
+        self.pages_loc = os.path.join(metadir.location, 'pages')
+        self.inotify = Inotify()
+        self.dirs = {}
+        self.status = {}
+        self.dirty = set()
+        self.changed_pages = set()
+        self.rescan = False
+        self.reload_pages = False
+        self.running = True
+
+    def _watch_tree(self, top):
+        for root, dirs, files in os.walk(top):
+            if root == self.metadir.root and '.mw' in dirs:
+                dirs.remove('.mw')
+            try:
+                wd = self.inotify.add_watch(root, watch_mask)
+            except OSError:
+                continue # gone already
+            self.dirs[wd] = root
+            for name in files:
+                if name.endswith('.wiki'):
+                    self.dirty.add(os.path.join(root,
+                                                name.decode('utf-8')))
+
+    def scan(self):
+        """
+        Watches the whole working directory and takes its status afresh.
+        """
+        self.dirs = {}
+        self._watch_tree(self.metadir.root)
+        wd = self.inotify.add_watch(self.metadir.location,
+                                    IN_CLOSE_WRITE | IN_MOVED_TO |
+                                    IN_MODIFY | IN_CREATE | IN_DELETE)
+        self.dirs[wd] = self.metadir.location
+        if os.path.isdir(self.pages_loc):
+            wd = self.inotify.add_watch(self.pages_loc,
+                                        IN_CLOSE_WRITE | IN_MOVED_TO |
+                                        IN_DELETE)
+            self.dirs[wd] = self.pages_loc
+        self.metadir._pagedata = {}
+        self.status = self.metadir.working_dir_status()
+        self.dirty = set()
+        self.changed_pages = set()
+        self.rescan = False
+        self.reload_pages = False
+
+    def handle_events(self):
+        for wd, mask, name in self.inotify.read():
+            if mask & IN_Q_OVERFLOW:
+                self.rescan = True
+                continue
+            if mask & IN_IGNORED:
+                self.dirs.pop(wd, None)
+                continue
+            directory = self.dirs.get(wd)
+            if directory is None:
+                continue
+            path = os.path.join(directory, name)
+            if directory == self.metadir.location:
+                if name == 'version' and self._version() != \
+                   self.metadir.version:
+                    # upgraded or replaced, our records are of no use
+                    self.running = False
+                elif name.startswith('pages.db'):
+                    self.reload_pages = True
+            elif directory == self.pages_loc:
+                if name.endswith('.wiki'):
+                    self.changed_pages.add(
+                        self.metadir.get_pagename_from_filename(name))
+            elif mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    self._watch_tree(path)
+                elif mask & IN_MOVED_FROM:
+                    # files under it moved with it
+                    self.rescan = True
+            elif name.endswith('.wiki'):
+                self.dirty.add(path)
+
+    def _version(self):
+        try:
+            with open(self.metadir.version_loc) as fd:
+                return fd.read()
+        except IOError:
+            return None
+
+    def _pages_changed(self):
+        """
+        Marks the working files of the pages whose records were written
+        since the last refresh, under their old and new paths.
+        """
+        for pagename in self.changed_pages:
+            old = self.metadir._pagedata.pop(pagename, None)
+            paths = [self.metadir.get_filename_from_pagename(pagename)]
+            if old is not None:
+                paths.append(old['path'])
+            if self.metadir.has_page(pagename):
+                paths.append(self.metadir.get_path(pagename))
+            for path in paths:
+                self.dirty.add(os.path.join(self.metadir.root, path))
+        self.changed_pages = set()
+
+    def _reload_pages(self):
+        """
+        Compares the page records of a packed metadir with the ones we
+        have, as there is no telling which changed from the events.
+        """
+        old = self.metadir._pagedata
+        new = dict(self.metadir.store.iter_meta())
+        for pagename in set(old) | set(new):
+            if old.get(pagename) != new.get(pagename):
+                for data in [old.get(pagename), new.get(pagename)]:
+                    if data is not None:
+                        self.dirty.add(os.path.join(self.metadir.root,
+                                                    data['path']))
+                self.dirty.add(os.path.join(
+                    self.metadir.root,
+                    self.metadir.get_filename_from_pagename(pagename)))
+        self.metadir._pagedata = new
+        self.reload_pages = False
+
+    def refresh(self):
+        """
+        Brings the status up to date with the events seen so far.
+        """
+        self.handle_events()
+        if self.rescan:
+            self.scan()
+            return
+        if self.reload_pages:
+            self._reload_pages()
+        self._pages_changed()
+        for filename in self.dirty:
+            # a scan lists the files there are and where pages should be
+            pagename = self.metadir.get_pagename_from_filename(filename)
+            if os.path.exists(filename) or \
+               (self.metadir.has_page(pagename) and
+                os.path.join(self.metadir.root,
+                             self.metadir.get_path(pagename)) == filename):
+                self.status[filename] = \
+                    self.metadir.get_status_filename(filename)
+            else:
+                self.status.pop(filename, None)
+        self.dirty = set()
+
+    def answer(self, request):
+        if request.get('stop'):
+            self.running = False
+            return {'stopping': True}
+        self.refresh()
+        files = request.get('files')
+        if files is None:
+            return {'status': self.status}
+        status = {}
+        for filename in files:
+            if not filename.endswith('.wiki'):
+                continue
+            if filename in self.status:
+                status[filename] = self.status[filename]
+            else:
+                status[filename] = self.metadir.get_status_filename(filename)
+        return {'status': status}
+
+    def serve(self, address, ready=None):
+        """
+        Answers clients on a Unix socket until asked to stop.  Once clients
+        can connect, a byte is written to the file descriptor ready.
+        """
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(address)
+        listener.listen(16)
+        if ready is not None:
+            os.write(ready, '.')
+            os.close(ready)
+        try:
+            while self.running:
+                readable = select.select([listener, self.inotify.fd], [],
+                                         [])[0]
+                if self.inotify.fd in readable:
+                    self.handle_events()
+                if listener in readable:
+                    connection = listener.accept()[0]
+                    try:
+                        self._serve_client(connection)
+                    finally:
+                        connection.close()
+        finally:
+            listener.close()
+            self.inotify.close()
+
+    def _serve_client(self, connection):
+        connection.settimeout(timeout)
+        try:
+            request = json.loads(_read_line(connection))
+            connection.sendall(json.dumps(self.answer(request)) + '\n')
+        except (socket.error, ValueError), e:
+            print >> sys.stderr, 'dropped a client: %s' % e
+
+
+def _read_line(connection):
+    chunks = []
+    while True:
+        chunk = connection.recv(64 * 1024)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        if chunk.endswith('\n'):
+            break
+    return ''.join(chunks)
+
+
+def socket_address(metadir):
+    """
+    Returns the address of the socket of the daemon of metadir.  Unix
+    socket paths are short, a relative path is used where the absolute
+    one is too long.
+    """
+    path = os.path.join(metadir.location, 'watch.sock')
+    if len(path) > 100:
+        path = os.path.relpath(path)
+    return path
+
+
+def ask(metadir, request):
+    """
+    Sends a request to the daemon of metadir and returns its answer, or
+    None if no daemon answered.
+    """
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.settimeout(timeout)
+    try:
+        client.connect(socket_address(metadir))
+        client.sendall(json.dumps(request) + '\n')
+        return json.loads(_read_line(client))
+    except (socket.error, ValueError):
+        return None
+    finally:
+        client.close()
+
+
+def status(metadir, files=None):
+    """
+    Returns the status of the working directory, or of files, as told by
+    the daemon, or None if there is none running.
+    """
+    answer = ask(metadir, {'files': files})
+    if answer is None or 'status' not in answer:
+        return None
+    return answer['status']
+
+
+def start(metadir, foreground=False):
+    """
+    Scans the working directory and serves its status until stopped, in a
+    daemon process unless foreground is set.  Returns the pid of the
+    daemon once it answers.
+    """
+    address = socket_address(metadir)
+    if ask(metadir, {'files': []}) is not None:
+        raise OSError(errno.EEXIST, 'already watching %s' % metadir.root)
+    if os.path.exists(address):
+        os.unlink(address) # left behind by a daemon that died
+    watcher = Watcher(metadir)
+    pid_loc = os.path.join(metadir.location, 'watch.pid')
+    ready = None
+    if not foreground:
+        read_end, ready = os.pipe()
+        pid = os.fork()
+        if pid > 0:
+            os.close(ready)
+            answered = os.read(read_end, 1)
+            os.close(read_end)
+            os.waitpid(pid, 0)
+            if not answered:
+                raise OSError(errno.ESRCH, 'the daemon did not start, see %s'
+                              % os.path.join(metadir.location, 'watch.log'))
+            with open(pid_loc) as fd:
+                return int(fd.read())
+        os.close(read_end)
+        os.setsid()
+        if os.fork() > 0:
+            os._exit(0)
+        _detach(os.path.join(metadir.location, 'watch.log'))
+    with open(pid_loc, 'w') as fd:
+        fd.write('%d\n' % os.getpid())
+    # let kill clean up like a stop request does
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        try:
+            watcher.scan()
+            if foreground:
+                print 'watching %s' % metadir.root
+                sys.stdout.flush()
+            watcher.serve(address, ready)
+        finally:
+            for path in [address, pid_loc]:
+                if os.path.exists(path):
+                    os.unlink(path)
+    except Exception:
+        if foreground:
+            raise
+        traceback.print_exc()
+    if not foreground:
+        os._exit(0)
+    return os.getpid()
+
+
+def _detach(log):
+    """
+    Points the standard file descriptors of a daemon away from the
+    terminal, writing output to log.
+    """
+    sys.stdout.flush()
+    sys.stderr.flush()
+    devnull = os.open(os.devnull, os.O_RDWR)
+    fd = os.open(log, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0644)
+    os.dup2(devnull, 0)
+    os.dup2(fd, 1)
+    os.dup2(fd, 2)
+    os.close(devnull)
+    os.close(fd)
+
+
+def stop(metadir):
+    """
+    Asks the daemon of metadir to exit.  Returns False if none answered.
+    """
+    return ask(metadir, {'stop': True}) is not None